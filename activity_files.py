@@ -0,0 +1,316 @@
+import gzip
+import io
+import os
+import time
+import zipfile
+import xml.etree.ElementTree as ET
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import fitdecode
+import pandas as pd
+from buffers import RecordBuffer
+from fit_cache import content_hash
+
+# FIT stores positions in semicircles
+SEMICIRCLES_PER_DEGREE = 11930465
+# Activity files of a Strava export, FIT files are always gzipped, GPX and TCX files may not be
+ACTIVITY_SUFFIXES = ('.fit.gz', '.gpx', '.gpx.gz', '.tcx', '.tcx.gz')
+# Point elements of GPX and TCX files, by local name without the namespace
+XML_POINTS = {'trkpt', 'Trackpoint'}
+# Attributes and elements inside a point read into a track, the TCX heart rate is in HeartRateBpm/Value
+XML_FIELDS = {
+    'time': 'timestamp', 'Time': 'timestamp',
+    'lat': 'lat', 'LatitudeDegrees': 'lat',
+    'lon': 'long', 'LongitudeDegrees': 'long',
+    'ele': 'altitude', 'AltitudeMeters': 'altitude',
+    'hr': 'heart_rate', 'Value': 'heart_rate',
+    'speed': 'speed', 'Speed': 'speed',
+    'DistanceMeters': 'distance',
+}
+# Defaults for the parallel decode stage
+FIT_WORKERS = os.cpu_count() or 1
+FIT_CHUNKSIZE = 16
+
+
+def match_members(zip_ref, filenames):
+    """
+    Match filenames listed in activities.csv to members of the uploaded ZIP archive.
+
+    Parameters:
+    zip_ref (zipfile.ZipFile): Opened Strava export archive.
+    filenames (iterable): 'Filename' values from activities.csv, e.g. 'activities/123.fit.gz'.
+
+    Returns:
+    dict: Mapping of listed filename to the archive member name holding it.
+    """
+    members = {}
+    for name in zip_ref.namelist():
+        members.setdefault(name, name)
+        # Archives zipped together with their parent folder keep it as a prefix
+        if '/' in name:
+            members.setdefault(name.split('/', 1)[1], name)
+    return {f: members[f] for f in filenames if f in members}
+
+
+def iter_activity_members(zip_path, filenames):
+    """
+    Read the still compressed activity files (ACTIVITY_SUFFIXES) listed in activities.csv.
+
+    Parameters:
+    zip_path (str or file-like): Path to the ZIP archive or the uploaded file itself.
+    filenames (iterable): 'Filename' values from activities.csv.
+
+    Yields:
+    tuple: Listed filename and the raw bytes of the member.
+    """
+    filenames = [f for f in filenames if isinstance(f, str) and f.endswith(ACTIVITY_SUFFIXES)]
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        for filename, member in match_members(zip_ref, filenames).items():
+            yield filename, zip_ref.read(member)
+
+
+def open_xml_member(filename, data):
+    """
+    Open a GPX or TCX member for streaming, decompressed on the fly when it is gzipped.
+
+    Parameters:
+    filename (str): Listed filename, its suffix tells whether the data is gzipped.
+    data (bytes): Raw member bytes.
+
+    Returns:
+    io.BufferedReader: Stream positioned at the XML declaration.
+    """
+    stream = gzip.GzipFile(fileobj=io.BytesIO(data)) if filename.endswith('.gz') else io.BufferedReader(io.BytesIO(data))
+    # Strava writes TCX files with whitespace before the XML declaration, which XML parsers reject
+    while True:
+        head = stream.peek(1)
+        blank = len(head) - len(head.lstrip())
+        if not head or blank == 0:
+            return stream
+        stream.read(blank)
+
+
+def iter_xml_points(stream):
+    """
+    Parse the track points of a GPX or TCX file one at a time.
+
+    The file is parsed incrementally with iterparse and every point is removed from the tree
+    once read, so memory does not grow with the length of the file.
+
+    Parameters:
+    stream (file-like): Decompressed GPX or TCX data.
+
+    Yields:
+    dict: Text of the XML_FIELDS found in one point, keyed by their track column.
+    """
+    parents = []
+    for event, elem in ET.iterparse(stream, events=('start', 'end')):
+        if event == 'start':
+            parents.append(elem)
+            continue
+        parents.pop()
+        if elem.tag.rsplit('}', 1)[-1] not in XML_POINTS:
+            continue
+        point = {XML_FIELDS[name]: value for name, value in elem.attrib.items() if name in XML_FIELDS}
+        for child in elem.iter():
+            name = child.tag.rsplit('}', 1)[-1]
+            if name in XML_FIELDS and child.text and child.text.strip():
+                point[XML_FIELDS[name]] = child.text.strip()
+        yield point
+        elem.clear()
+        if parents:
+            # Points are removed as they come, so this is always the first child
+            parents[-1].remove(elem)
+
+
+def read_xml_start_record(stream):
+    """
+    Read GPX or TCX data until the first point that carries a time and coordinates.
+
+    Parameters:
+    stream (file-like): Decompressed GPX or TCX data.
+
+    Returns:
+    tuple or None: POSIX timestamp, latitude and longitude (in semicircles) or None if the file has no position.
+    """
+    for point in iter_xml_points(stream):
+        if 'timestamp' in point and 'lat' in point and 'long' in point:
+            # Times without a zone are UTC, as the GPX and TCX schemas require
+            return (
+                pd.Timestamp(point['timestamp']).timestamp(),
+                round(float(point['lat']) * SEMICIRCLES_PER_DEGREE),
+                round(float(point['long']) * SEMICIRCLES_PER_DEGREE),
+            )
+    return None
+
+
+def read_start_record(stream):
+    """
+    Read FIT data until the first 'record' message that carries coordinates.
+
+    Parameters:
+    stream (file-like): Decompressed FIT data.
+
+    Returns:
+    tuple or None: POSIX timestamp, latitude and longitude (in semicircles) or None if the file has no position.
+    """
+    with fitdecode.FitReader(stream) as fit_file:
+        for frame in fit_file:
+            if (isinstance(frame, fitdecode.records.FitDataMessage) and frame.name == 'record'):
+                # See if there are coordinates
+                try:
+                    start = (
+                        frame.get_value('timestamp').timestamp(),
+                        int(frame.get_value('position_lat')),
+                        int(frame.get_value('position_long')),
+                    )
+                except Exception:
+                    continue
+                return start
+    return None
+
+
+def decode_chunk(chunk):
+    """
+    Decode the start record of every activity file in a chunk, used as the process pool worker.
+
+    Parameters:
+    chunk (list): Pairs of listed filename and raw member bytes.
+
+    Returns:
+    list: Tuples of filename, POSIX timestamp, latitude and longitude, the last three are None for files without a position.
+    """
+    results = []
+    for filename, data in chunk:
+        try:
+            if filename.endswith('.fit.gz'):
+                start = read_start_record(io.BytesIO(gzip.decompress(data)))
+            else:
+                start = read_xml_start_record(open_xml_member(filename, data))
+        except Exception:
+            # Skip corrupted or truncated files instead of failing the whole export
+            start = None
+        results.append((filename, *(start or (None, None, None))))
+    return results
+
+
+def map_members(zip_path, filenames, worker, max_workers=FIT_WORKERS, chunksize=FIT_CHUNKSIZE, uncached=None, counts=None):
+    """
+    Run a worker over the listed archive members in a pool of processes.
+
+    Members are read from the archive in the calling process and handed to the workers in chunks.
+    At most two chunks per worker are in flight so memory stays bounded.
+
+    Parameters:
+    zip_path (str or file-like): Path to the ZIP archive or the uploaded file itself.
+    filenames (iterable): 'Filename' values from activities.csv.
+    worker (callable): Picklable function taking a list of (filename, raw member bytes) pairs and returning a list of results.
+    max_workers (int): Number of worker processes, 1 runs the worker in the calling process.
+    chunksize (int): Number of files sent to a worker at once.
+    uncached (callable): Optional filter taking a list of members and returning the ones still to be decoded.
+    counts (dict): Optional dict, its 'files' entry counts the members read from the archive.
+
+    Yields:
+    list: Worker results of one chunk, in the order the chunks are finished.
+    """
+    if counts is None:
+        counts = {}
+    counts['files'] = 0
+
+    def chunks():
+        chunk, lookup = [], []
+        for member in iter_activity_members(zip_path, filenames):
+            counts['files'] += 1
+            lookup.append(member)
+            if len(lookup) == chunksize:
+                chunk.extend(uncached(lookup) if uncached else lookup)
+                lookup = []
+                if len(chunk) >= chunksize:
+                    yield chunk[:chunksize]
+                    chunk = chunk[chunksize:]
+        if lookup:
+            chunk.extend(uncached(lookup) if uncached else lookup)
+        if chunk:
+            yield chunk
+
+    if max_workers <= 1:
+        for chunk in chunks():
+            yield worker(chunk)
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            pending = set()
+            for chunk in chunks():
+                pending.add(executor.submit(worker, chunk))
+                if len(pending) >= 2 * max_workers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+            for future in pending:
+                yield future.result()
+
+
+def decode_start_records(zip_path, filenames, max_workers=FIT_WORKERS, chunksize=FIT_CHUNKSIZE, cache=None, progress=None):
+    """
+    Decode the start records of the listed FIT, GPX and TCX files in parallel.
+
+    With a cache only the files whose content has not been seen before are decoded.
+
+    Parameters:
+    zip_path (str or file-like): Path to the ZIP archive or the uploaded file itself.
+    filenames (iterable): 'Filename' values from activities.csv.
+    max_workers (int): Number of worker processes, 1 decodes in the calling process.
+    chunksize (int): Number of files sent to a worker at once.
+    cache (FitCache): Optional persistent cache of already decoded files.
+    progress (callable): Optional callback taking the number of files done and the number of listed files.
+
+    Returns:
+    tuple: DataFrame with 'Filename', 'timestamp', 'lat' and 'long' columns and a dict with throughput stats.
+    """
+    start_time = time.perf_counter()
+    coords = RecordBuffer({'Filename': None, 'timestamp': 'd', 'lat': 'q', 'long': 'q'})
+    filenames = list(filenames)
+    hashes = {}
+    counts = {}
+    n_decoded = n_cached = 0
+
+    def uncached(chunk):
+        # Serve the files seen before from the cache and return the rest
+        nonlocal n_cached
+        chunk_hashes = {filename: content_hash(data) for filename, data in chunk}
+        found = cache.get_many(list(chunk_hashes.values()))
+        n_cached += len(found)
+        missing = []
+        for filename, data in chunk:
+            h = chunk_hashes[filename]
+            if h in found:
+                if found[h][1] is not None:
+                    coords.append(filename, *found[h])
+            else:
+                hashes[filename] = h
+                missing.append((filename, data))
+        return missing
+
+    for decoded in map_members(zip_path, filenames, decode_chunk, max_workers, chunksize,
+                               uncached=uncached if cache is not None else None, counts=counts):
+        n_decoded += len(decoded)
+        # Files without a position are only needed by the cache
+        coords.extend(r for r in decoded if r[2] is not None)
+        if cache is not None:
+            cache.put_many([(hashes.pop(filename), *start) for filename, *start in decoded])
+        if progress is not None:
+            progress(n_cached + n_decoded, len(filenames))
+    if progress is not None:
+        progress(len(filenames), len(filenames))
+
+    # Scale semicircles to degrees for all files at once
+    coords = coords.to_frame(scale={'lat': SEMICIRCLES_PER_DEGREE, 'long': SEMICIRCLES_PER_DEGREE})
+    coords['timestamp'] = pd.to_datetime(coords['timestamp'], unit='s', utc=True)
+    seconds = time.perf_counter() - start_time
+    stats = {
+        'files': counts['files'],
+        'decoded': n_decoded,
+        'seconds': seconds,
+        'files_per_second': counts['files'] / seconds if seconds > 0 else 0.0,
+    }
+    if cache is not None:
+        stats.update({f'cache_{k}': v for k, v in cache.stats().items()})
+    return coords, stats
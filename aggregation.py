@@ -0,0 +1,163 @@
+import pandas as pd
+
+# Time units available for the charts, from the finest to the coarsest
+TIME_UNITS = ['Day', 'Week', 'Month', 'Quarter', 'Year']
+
+
+def period_totals(df, time_unit):
+    """
+    Sum activities by time period and activity type.
+
+    Only counts and sums are kept, so the totals can be updated by adding and subtracting activities.
+
+    Parameters:
+    df (pandas.DataFrame): Activities with period columns, 'Activity Type', 'Distance (km)' and 'Moving Time (hr)'.
+    time_unit (str): One of TIME_UNITS.
+
+    Returns:
+    pandas.DataFrame: Counts and sums indexed by period and activity type.
+    """
+    return df.groupby(by=[time_unit, 'Activity Type'], observed=True).agg(
+        count=('Distance (km)', 'count'),
+        total_distance_km=('Distance (km)', 'sum'),
+        hr_count=('Moving Time (hr)', 'count'),
+        total_hr_spent=('Moving Time (hr)', 'sum'),
+    )
+
+
+def update_totals(totals, time_unit, added=None, removed=None):
+    """
+    Update period totals with added and removed activities without going over the whole history.
+
+    Parameters:
+    totals (pandas.DataFrame): Output of period_totals.
+    time_unit (str): One of TIME_UNITS.
+    added (pandas.DataFrame): New activities.
+    removed (pandas.DataFrame): Activities to take out, e.g. the previous version of changed ones.
+
+    Returns:
+    pandas.DataFrame: Updated totals.
+    """
+    parts = [totals]
+    if added is not None and len(added):
+        parts.append(period_totals(added, time_unit))
+    if removed is not None and len(removed):
+        parts.append(-period_totals(removed, time_unit))
+    combined = pd.concat(parts).groupby(level=[0, 1], observed=True).sum()
+    # A full rebuild would have no rows for combinations left without activities
+    return combined.loc[(combined['count'] > 0) | (combined['hr_count'] > 0)]
+
+
+def rollup_from_totals(totals, time_unit):
+    """
+    Turn period totals into the rollup behind the charts on a dense grid.
+
+    Every (period, activity type) combination gets a row, so there is a point on the plots for
+    each of them, and the cumulative distance is computed per activity type.
+
+    Parameters:
+    totals (pandas.DataFrame): Output of period_totals or update_totals.
+    time_unit (str): One of TIME_UNITS.
+
+    Returns:
+    pandas.DataFrame: One row per period and activity type with counts, totals, averages and 'csum_km'.
+    """
+    grouped = pd.DataFrame({
+        'count': totals['count'],
+        'total_distance_km': totals['total_distance_km'],
+        'avg_distance_km': totals['total_distance_km'] / totals['count'],
+        'total_hr_spent': totals['total_hr_spent'],
+        'avg_hr_spent': totals['total_hr_spent'] / totals['hr_count'],
+    })
+    # Reindex on the full grid of periods and activity types, missing combinations are zeros
+    grid = pd.MultiIndex.from_product(
+        [grouped.index.unique(level=0).sort_values(), grouped.index.unique(level=1)],
+        names=[time_unit, 'Activity Type'],
+    )
+    dense = grouped.reindex(grid, fill_value=0)
+    # Grid is ordered by period, so a grouped cumulative sum runs through time for each activity
+    dense['csum_km'] = dense.groupby(level='Activity Type', observed=True)['total_distance_km'].cumsum()
+    return dense.reset_index()
+
+
+def build_totals(df):
+    """
+    Compute the period totals for every time unit.
+
+    Parameters:
+    df (pandas.DataFrame): Activities with period columns.
+
+    Returns:
+    dict: Mapping of time unit to its totals DataFrame.
+    """
+    return {time_unit: period_totals(df, time_unit) for time_unit in TIME_UNITS}
+
+
+def rollups_from_totals(totals):
+    """
+    Build the rollups of every time unit from their totals.
+
+    Parameters:
+    totals (dict): Mapping of time unit to its totals DataFrame.
+
+    Returns:
+    dict: Mapping of time unit to its rollup DataFrame.
+    """
+    return {time_unit: rollup_from_totals(totals[time_unit], time_unit) for time_unit in TIME_UNITS}
+
+
+def build_rollups(df):
+    """
+    Precompute the rollups for every time unit once per dataset.
+
+    Parameters:
+    df (pandas.DataFrame): Activities with period columns.
+
+    Returns:
+    dict: Mapping of time unit to its rollup DataFrame.
+    """
+    return rollups_from_totals(build_totals(df))
+
+
+def cumulative_distance(rollup, min_total_km=1):
+    """
+    Select the activity types worth showing on the cumulative distance chart.
+
+    Parameters:
+    rollup (pandas.DataFrame): Rollup of one time unit.
+    min_total_km (float): Activity types with this many kilometers or less in total are excluded.
+
+    Returns:
+    pandas.DataFrame: Rollup rows of the remaining activity types.
+    """
+    totals = rollup.groupby('Activity Type', observed=True)['total_distance_km'].transform('sum')
+    return rollup.loc[totals > min_total_km]
+
+
+def with_labels(frame, time_unit):
+    """
+    Format the periods of a rollup as text labels for plotting.
+
+    Periods are kept as pandas Period values everywhere else, so they sort by time and take 8 bytes per row.
+
+    Parameters:
+    frame (pandas.DataFrame): Rollup rows.
+    time_unit (str): One of TIME_UNITS.
+
+    Returns:
+    pandas.DataFrame: Copy of the rows with the period column as strings.
+    """
+    return frame.assign(**{time_unit: frame[time_unit].astype(str)})
+
+
+def time_spent(rollup):
+    """
+    Select the rollup rows with activities for the time spent chart.
+
+    Parameters:
+    rollup (pandas.DataFrame): Rollup of one time unit.
+
+    Returns:
+    pandas.DataFrame: Rollup rows with at least one activity.
+    """
+    return rollup.loc[rollup['count'] > 0]
@@ -0,0 +1,177 @@
+import os
+import re
+import shutil
+import numpy as np
+import pandas as pd
+from aggregation import TIME_UNITS
+from fit_cache import CACHE_DIR, content_hash
+
+# Column of the stored activities with the hash of their activities.csv row
+ROW_HASH = 'Row Hash'
+# Number of oldest activities an export can find its store by, so editing or deleting a few of
+# them does not lose the store
+STORE_KEY_ROWS = 5
+
+
+def row_hashes(df, columns):
+    """
+    Hash the activities.csv columns of every activity, so changed rows can be told apart.
+
+    Parameters:
+    df (pandas.DataFrame): Activities.
+    columns (list): Columns read from activities.csv.
+
+    Returns:
+    numpy.ndarray: One 64-bit hash per row.
+    """
+    return pd.util.hash_pandas_object(df[columns], index=False).to_numpy()
+
+
+def store_keys(df, hashes):
+    """
+    Derive the keys the store of an export can be found under.
+
+    A key is the hash of the whole activities.csv row of one of the oldest activities, heart rate
+    and effort included, so only someone holding the export can derive it and the store does not
+    depend on anything typed in. Keys are ordered from the oldest activity.
+
+    Parameters:
+    df (pandas.DataFrame): Activities of the export.
+    hashes (numpy.ndarray): Row hashes of df, see row_hashes.
+
+    Returns:
+    list: Hex keys, at most STORE_KEY_ROWS of them.
+    """
+    oldest = np.argsort(df['Activity Date'].to_numpy(), kind='stable')[:STORE_KEY_ROWS]
+    ids = df['Activity ID'].to_numpy()
+    return [content_hash(f'{ids[i]}:{hashes[i]}'.encode()) for i in oldest]
+
+
+def diff_activities(stored, ids, hashes):
+    """
+    Compare the activities of an upload with the stored ones by 'Activity ID' and row hash.
+
+    Parameters:
+    stored (pandas.DataFrame): Stored activities with their ROW_HASH column.
+    ids (array-like): 'Activity ID' values of the upload.
+    hashes (numpy.ndarray): Row hashes of the upload.
+
+    Returns:
+    tuple: Boolean masks of the uploaded rows that are new or changed and of the stored rows that
+    were changed or deleted since.
+    """
+    uploaded = pd.MultiIndex.from_arrays([ids, hashes])
+    kept = pd.MultiIndex.from_arrays([stored['Activity ID'], stored[ROW_HASH]])
+    return ~uploaded.isin(kept), ~kept.isin(uploaded)
+
+
+class AthleteStore:
+    """
+    Activities of one athlete kept between uploads, keyed by 'Activity ID'.
+
+    The store is a directory with the activities and their start coordinates in one Parquet file, the
+    period totals behind the charts in one Parquet file per time unit and the daily training load in
+    another one. Files are written under a temporary name and renamed, so an interrupted save never
+    leaves a half written file behind.
+
+    A store is only ever opened for an uploaded export (see for_export). Its directory is named by
+    the first of the store_keys of the export that created it, the other keys of every saved
+    export are aliases: small files named by the key holding the directory name.
+    """
+
+    def __init__(self, key, directory=None, aliases=()):
+        """
+        Parameters:
+        key (str): One of store_keys, used as the directory name.
+        directory (str): Parent directory of all athlete stores, CACHE_DIR/athletes by default.
+        aliases (iterable): Other keys of the export, written as aliases on save.
+        """
+        for name in [key, *aliases]:
+            if not re.fullmatch(r'[0-9a-f]{40}', name):
+                raise ValueError(f'Invalid store key: {name!r}')
+        self.root = directory or os.path.join(CACHE_DIR, 'athletes')
+        self.key = key
+        self.aliases = [alias for alias in aliases if alias != key]
+        self.path = os.path.join(self.root, key)
+
+    @classmethod
+    def for_export(cls, df, hashes, directory=None):
+        """
+        Open the store of an export, the one created by an earlier export of the same athlete if any.
+
+        Parameters:
+        df (pandas.DataFrame): Activities of the export.
+        hashes (numpy.ndarray): Row hashes of df, see row_hashes.
+        directory (str): Parent directory of all athlete stores, CACHE_DIR/athletes by default.
+
+        Returns:
+        AthleteStore: Existing store found by one of the store_keys, directly or through an alias,
+        a new one under the first key otherwise.
+        """
+        keys = store_keys(df, hashes)
+        if not keys:
+            raise ValueError('An export without activities has no store')
+        root = directory or os.path.join(CACHE_DIR, 'athletes')
+        for key in keys:
+            alias = os.path.join(root, f'{key}.alias')
+            if os.path.exists(alias):
+                with open(alias) as f:
+                    key = f.read().strip()
+            store = cls(key, directory, aliases=keys)
+            if store.exists():
+                return store
+        return cls(keys[0], directory, aliases=keys)
+
+    def _file(self, name):
+        return os.path.join(self.path, f'{name}.parquet')
+
+    def exists(self):
+        return all(os.path.exists(self._file(name)) for name in ['activities', *TIME_UNITS])
+
+    def load(self):
+        """
+        Read the stored activities, period totals and training load.
+
+        Returns:
+        tuple: Activities with coordinate and ROW_HASH columns, a dict of totals per time unit and
+        the training load series, all None when nothing is stored yet. The training load is None
+        for stores saved before it was kept.
+        """
+        if not self.exists():
+            return None, None, None
+        activities = pd.read_parquet(self._file('activities'))
+        totals = {time_unit: pd.read_parquet(self._file(time_unit)) for time_unit in TIME_UNITS}
+        load = pd.read_parquet(self._file('load')) if os.path.exists(self._file('load')) else None
+        return activities, totals, load
+
+    def save(self, activities, totals, load):
+        """
+        Replace the stored activities, period totals and training load.
+
+        Parameters:
+        activities (pandas.DataFrame): Activities with coordinate and ROW_HASH columns.
+        totals (dict): Mapping of time unit to its totals DataFrame.
+        load (pandas.DataFrame): Training load series indexed by day.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        for name, frame in [('activities', activities), *totals.items(), ('load', load)]:
+            path = self._file(name)
+            frame.to_parquet(f'{path}.tmp', index=name != 'activities')
+            os.replace(f'{path}.tmp', path)
+        for alias in self.aliases:
+            path = os.path.join(self.root, f'{alias}.alias')
+            with open(f'{path}.tmp', 'w') as f:
+                f.write(self.key)
+            os.replace(f'{path}.tmp', path)
+
+    def clear(self):
+        """
+        Delete everything stored for the athlete, with the aliases pointing to it.
+        """
+        shutil.rmtree(self.path, ignore_errors=True)
+        for name in os.listdir(self.root) if os.path.isdir(self.root) else []:
+            if name.endswith('.alias'):
+                path = os.path.join(self.root, name)
+                with open(path) as f:
+                    if f.read().strip() == self.key:
+                        os.remove(path)
@@ -0,0 +1,51 @@
+import threading
+from instrument import Trace
+
+
+class BackgroundJob:
+    """
+    Runs a pipeline function in a daemon thread and keeps its progress, trace, result and error.
+
+    The function is called with two extra keyword arguments: 'progress', a callback taking the
+    number of items done and the total, and 'trace', the Trace of the job. Streamlit reruns the
+    page script on every interaction, so the job is kept in st.session_state and a new run picks
+    up the same job instead of starting over. The function must not call Streamlit itself.
+
+    The trace of the job records no memory: tracemalloc is process wide, so stages running in two
+    threads at once would reset each other's peak and stop each other's tracing.
+    """
+
+    def __init__(self, target, *args, **kwargs):
+        self.done_count = 0
+        self.total = 0
+        self.result = None
+        self.error = None
+        self.trace = Trace()
+        self._thread = threading.Thread(target=self._run, args=(target, args, kwargs), daemon=True)
+        self._thread.start()
+
+    def _run(self, target, args, kwargs):
+        try:
+            self.result = target(*args, progress=self._progress, trace=self.trace, **kwargs)
+        except Exception as e:
+            self.error = e
+
+    def _progress(self, done, total):
+        self.done_count, self.total = done, total
+
+    @property
+    def fraction(self):
+        return min(self.done_count / self.total, 1.0) if self.total else 0.0
+
+    def done(self):
+        return not self._thread.is_alive()
+
+    def wait(self, timeout=None):
+        """
+        Block until the job is finished or the timeout in seconds passed.
+
+        Returns:
+        bool: Whether the job is finished.
+        """
+        self._thread.join(timeout)
+        return self.done()
@@ -0,0 +1,69 @@
+import argparse
+import glob
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from fit_cache import FitCache
+from pipeline import process_export, save_results
+
+
+def process_to_parquet(export_path, output_dir, use_cache=True):
+    """
+    Process one Strava export ZIP and write the result next to the others.
+
+    Parameters:
+    export_path (str): Full Strava export archive with activities.csv and the activities/ folder.
+    output_dir (str): Directory for the .parquet outputs.
+    use_cache (bool): Whether to use the persistent FIT cache.
+
+    Returns:
+    tuple: Path of the written file and FIT decode stats.
+    """
+    name = os.path.splitext(os.path.basename(export_path))[0]
+    path = os.path.join(output_dir, f'{name}.parquet')
+    # Exports are already spread over processes, so FIT files are decoded in this one
+    if use_cache:
+        with FitCache() as cache:
+            results = process_export(export_path, cache=cache, max_workers=1)
+    else:
+        results = process_export(export_path, max_workers=1)
+    save_results(results, path)
+    return path, results['stats']
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Process a directory of Strava export ZIPs into Parquet files the strava page can load.')
+    parser.add_argument('input_dir', help='directory with Strava export ZIP archives')
+    parser.add_argument('output_dir', help='directory for the .parquet outputs')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='number of exports processed in parallel')
+    parser.add_argument('--no-cache', action='store_true', help='do not use the persistent FIT cache')
+    args = parser.parse_args(argv)
+
+    exports = sorted(glob.glob(os.path.join(args.input_dir, '*.zip')))
+    if not exports:
+        parser.error(f'no ZIP archives found in {args.input_dir}')
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    start_time = time.perf_counter()
+    failed = 0
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = {executor.submit(process_to_parquet, export, args.output_dir, not args.no_cache): export for export in exports}
+        for future in as_completed(futures):
+            export = futures[future]
+            try:
+                path, stats = future.result()
+            except Exception as e:
+                # One broken export should not stop the rest of the batch
+                failed += 1
+                print(f'{export}: failed: {e}', file=sys.stderr)
+                continue
+            print(f"{export}: {stats['files']} FIT files in {stats['seconds']:.1f} s -> {path}")
+    seconds = time.perf_counter() - start_time
+    print(f'Processed {len(exports) - failed} of {len(exports)} exports in {seconds:.1f} s')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,240 @@
+import argparse
+import csv
+import gzip
+import json
+import os
+import platform
+import sys
+import time
+import zipfile
+import numpy as np
+from fitdecode.utils import compute_crc
+import pipeline
+from activity_files import FIT_CHUNKSIZE, SEMICIRCLES_PER_DEGREE
+from aggregation import TIME_UNITS
+from instrument import Trace, max_rss_mb
+
+# Seconds between the FIT epoch (1989-12-31) and the Unix epoch
+FIT_EPOCH = 631065600
+# Header written by a real Strava export, 'Distance' appears twice and is read back as 'Distance.1'
+CSV_HEADER = ['Activity ID', 'Activity Date', 'Activity Name', 'Activity Type', 'Activity Description', 'Elapsed Time',
+              'Distance', 'Max Heart Rate', 'Relative Effort', 'Commute', 'Filename', 'Moving Time', 'Distance',
+              'Max Speed', 'Elevation Gain', 'Average Heart Rate']
+# Activity types with their share and typical speed in m/s
+ACTIVITY_TYPES = {'Run': (0.6, 3.0), 'Ride': (0.25, 7.5), 'Walk': (0.1, 1.4), 'Hike': (0.05, 1.1)}
+# record message: timestamp, position_lat, position_long, altitude, heart_rate, distance, speed
+RECORD_FIELDS = [(253, 4, 0x86), (0, 4, 0x85), (1, 4, 0x85), (2, 2, 0x84), (3, 1, 0x02), (5, 4, 0x86), (6, 2, 0x84)]
+RECORD_DTYPE = np.dtype([('header', 'u1'), ('timestamp', '<u4'), ('lat', '<i4'), ('long', '<i4'), ('altitude', '<u2'),
+                         ('heart_rate', 'u1'), ('distance', '<u4'), ('speed', '<u2')])
+
+
+def fit_file(start_time, n_records, lat, long, speed, interval, rng):
+    """
+    Encode a minimal but valid FIT activity file with a file_id message and n_records record messages.
+
+    Parameters:
+    start_time (int): POSIX timestamp of the first record.
+    n_records (int): Number of record messages.
+    lat, long (float): Start position in degrees.
+    speed (float): Average speed in m/s.
+    interval (int): Seconds between records.
+    rng (numpy.random.Generator): Random generator for the noise.
+
+    Returns:
+    bytes: FIT file content.
+    """
+    body = bytearray()
+    # file_id definition (local message 0): type, manufacturer, time_created
+    body += bytes([0x40, 0, 0]) + (0).to_bytes(2, 'little') + bytes([3, 0, 1, 0x00, 1, 2, 0x84, 4, 4, 0x86])
+    body += bytes([0x00, 4]) + (1).to_bytes(2, 'little') + (start_time - FIT_EPOCH).to_bytes(4, 'little')
+    # record definition (local message 1)
+    body += bytes([0x41, 0, 0]) + (20).to_bytes(2, 'little') + bytes([len(RECORD_FIELDS)])
+    body += bytes(b for field in RECORD_FIELDS for b in field)
+    # Random walk around the start position with noisy speed, heart rate and altitude
+    speeds = np.clip(speed * (1 + 0.15 * rng.standard_normal(n_records)), 0.1, None)
+    distance = np.cumsum(speeds * interval)
+    heading = np.cumsum(0.2 * rng.standard_normal(n_records))
+    step = speeds * interval / 111_320
+    records = np.zeros(n_records, dtype=RECORD_DTYPE)
+    records['header'] = 0x01
+    records['timestamp'] = start_time - FIT_EPOCH + interval * np.arange(n_records)
+    records['lat'] = (lat + np.cumsum(step * np.cos(heading))) * SEMICIRCLES_PER_DEGREE
+    records['long'] = (long + np.cumsum(step * np.sin(heading))) * SEMICIRCLES_PER_DEGREE
+    records['altitude'] = (150 + np.cumsum(rng.standard_normal(n_records)) + 500) * 5
+    records['heart_rate'] = np.clip(140 + np.cumsum(rng.standard_normal(n_records)), 60, 200)
+    records['distance'] = distance * 100
+    records['speed'] = speeds * 1000
+    body += records.tobytes()
+    header = bytes([14, 0x20]) + (2100).to_bytes(2, 'little') + len(body).to_bytes(4, 'little') + b'.FIT'
+    header += compute_crc(header).to_bytes(2, 'little')
+    data = header + bytes(body)
+    return data + compute_crc(data).to_bytes(2, 'little')
+
+
+def generate_export(directory, n_activities, seed=0, interval=5):
+    """
+    Write a synthetic Strava export with activities.csv and activities.zip.
+
+    Existing exports in the directory are reused, so the slow generation happens once per size.
+
+    Parameters:
+    directory (str): Destination directory.
+    n_activities (int): Number of activities.
+    seed (int): Random seed.
+    interval (int): Seconds between FIT records, 1 for every second recording, 5 for smart recording.
+
+    Returns:
+    tuple: Paths of activities.csv and activities.zip.
+    """
+    csv_path = os.path.join(directory, 'activities.csv')
+    zip_path = os.path.join(directory, 'activities.zip')
+    if os.path.exists(csv_path) and os.path.exists(zip_path):
+        return csv_path, zip_path
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    types = list(ACTIVITY_TYPES)
+    shares = [ACTIVITY_TYPES[t][0] for t in types]
+    # A few home bases with most activities close to them
+    bases = rng.uniform([-50, -120], [60, 140], size=(5, 2))
+    start = 1262304000  # 2010-01-01
+    starts = np.sort(rng.integers(start, start + 14 * 365 * 86400, n_activities))
+    with open(csv_path, 'w', newline='') as f, zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_STORED) as zip_ref:
+        writer = csv.writer(f)
+        writer.writerow(CSV_HEADER)
+        for i, start_time in enumerate(starts.tolist()):
+            activity_id = 1_000_000_000 + i
+            activity_type = types[rng.choice(len(types), p=shares)]
+            speed = ACTIVITY_TYPES[activity_type][1] * rng.uniform(0.8, 1.2)
+            moving_time = int(rng.uniform(20, 120) * 60)
+            n_records = max(moving_time // interval, 1)
+            distance = speed * moving_time
+            base = bases[rng.choice(len(bases), p=[0.6, 0.2, 0.1, 0.05, 0.05])]
+            lat, long = base + rng.normal(0, 0.05, 2)
+            # Manual activities have no file
+            filename = f'activities/{activity_id}.fit.gz' if rng.random() > 0.03 else ''
+            if filename:
+                data = fit_file(start_time, n_records, lat, long, speed, interval, rng)
+                zip_ref.writestr(filename, gzip.compress(data, compresslevel=6))
+            writer.writerow([
+                activity_id,
+                time.strftime('%b %d, %Y, %I:%M:%S %p', time.gmtime(start_time)),
+                f'{activity_type} #{i}',
+                activity_type,
+                '',
+                int(moving_time * 1.1),
+                f'{distance / 1000:.2f}',
+                int(rng.uniform(150, 195)),
+                int(rng.uniform(5, 250)),
+                'false',
+                filename,
+                moving_time,
+                f'{distance:.1f}',
+                f'{speed * 1.5:.1f}',
+                f'{rng.uniform(0, 800):.1f}',
+                f'{rng.uniform(120, 165):.1f}',
+            ])
+    return csv_path, zip_path
+
+
+def build_figures(rollups, cdf):
+    """
+    Build and serialize every chart of the strava page for each time unit.
+
+    Returns:
+    int: Total size of the serialized figures in bytes.
+    """
+    from strava import distance_figure, map_figure, time_figure
+    figures = [map_figure(cdf)]
+    for time_unit in TIME_UNITS:
+        figures += [distance_figure(rollups[time_unit], time_unit), time_figure(rollups[time_unit], time_unit)]
+    return sum(len(fig.to_json()) for fig in figures)
+
+
+def run(csv_path, zip_path, max_workers=1, chunksize=FIT_CHUNKSIZE, track_memory=True):
+    """
+    Time every stage of the pipeline on one export.
+
+    Returns:
+    dict: Per stage timings and peak memory, row and file counts.
+    """
+    # Import Streamlit and Plotly up front so the figure stage does not pay for it
+    import strava  # noqa: F401
+    trace = Trace(track_memory=track_memory)
+    results = pipeline.process_export(zip_path, csv=csv_path, max_workers=max_workers, chunksize=chunksize, trace=trace)
+    with trace.stage('figure_build') as stage:
+        stage['bytes'] = build_figures(results['rollups'], results['cdf'])
+    stages = {record.pop('stage'): record for record in trace.stages}
+    return {
+        'activities': len(results['df']),
+        'fit_files': results['stats']['files'],
+        'located': len(results['cdf']),
+        'activities_mb_per_10k': results['df'].memory_usage(deep=True).sum() / 2**20 / len(results['df']) * 10_000,
+        'figure_bytes': stages['figure_build']['bytes'],
+        'fit_files_per_second': results['stats']['files_per_second'],
+        'total_seconds': trace.total_seconds(),
+        'stages': stages,
+        'max_rss_mb': max_rss_mb(),
+    }
+
+
+def compare(baseline, current):
+    """
+    Print the per stage time ratio of two benchmark reports.
+
+    Parameters:
+    baseline (dict): Earlier report.
+    current (dict): New report.
+    """
+    previous = {r['activities']: r for r in baseline['runs']}
+    for r in current['runs']:
+        old = previous.get(r['activities'])
+        if old is None:
+            continue
+        print(f"{r['activities']} activities:")
+        for name, stage in r['stages'].items():
+            if name in old['stages']:
+                ratio = stage['wall_seconds'] / old['stages'][name]['wall_seconds'] if old['stages'][name]['wall_seconds'] else float('nan')
+                print(f"  {name:<18} {old['stages'][name]['wall_seconds']:8.3f} s -> {stage['wall_seconds']:8.3f} s  x{ratio:.2f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the strava pipeline on synthetic Strava exports.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000, 50000], help='numbers of activities')
+    parser.add_argument('--workdir', default='benchmark_data', help='directory for the generated exports')
+    parser.add_argument('--output', help='write the JSON report to this file instead of stdout')
+    parser.add_argument('--compare', help='earlier JSON report to compare the results with')
+    parser.add_argument('--interval', type=int, default=5, help='seconds between FIT records')
+    parser.add_argument('--workers', type=int, default=1, help='FIT decode worker processes')
+    parser.add_argument('--chunksize', type=int, default=FIT_CHUNKSIZE, help='FIT files sent to a worker at once')
+    parser.add_argument('--no-memory', action='store_true', help='do not trace memory, tracing slows the stages down')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'settings': {k: v for k, v in vars(args).items() if k not in ('output', 'compare')},
+        'runs': [],
+    }
+    for size in args.sizes:
+        directory = os.path.join(args.workdir, f'export-{size}-{args.seed}-{args.interval}s')
+        print(f'Generating {size} activities in {directory}', file=sys.stderr)
+        csv_path, zip_path = generate_export(directory, size, seed=args.seed, interval=args.interval)
+        print(f'Running pipeline on {size} activities', file=sys.stderr)
+        report['runs'].append(run(csv_path, zip_path, max_workers=args.workers, chunksize=args.chunksize,
+                                  track_memory=not args.no_memory))
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+
+if __name__ == '__main__':
+    main()
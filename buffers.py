@@ -0,0 +1,69 @@
+from array import array
+import numpy as np
+import pandas as pd
+
+
+class RecordBuffer:
+    """
+    Columnar buffer that collects rows into typed arrays and builds a single DataFrame at the end.
+
+    Numeric columns are kept in array.array storage with the given type code, e.g. 'd' for floats
+    and 'q' for 64-bit integers. Columns with a None type code keep Python objects such as strings.
+    """
+
+    __slots__ = ('columns', '_data')
+
+    def __init__(self, schema):
+        """
+        Parameters:
+        schema (dict): Mapping of column name to an array type code or None for object columns.
+        """
+        self.columns = list(schema)
+        self._data = [array(code) if code else [] for code in schema.values()]
+
+    def __len__(self):
+        return len(self._data[0]) if self._data else 0
+
+    def append(self, *values):
+        """
+        Append one row, values are given in the column order of the schema.
+        """
+        for column, value in zip(self._data, values):
+            column.append(value)
+
+    def extend(self, rows):
+        """
+        Append many rows at once.
+
+        Parameters:
+        rows (iterable): Tuples with values in the column order of the schema.
+        """
+        for row in rows:
+            self.append(*row)
+
+    def to_arrays(self):
+        """
+        Convert the collected columns to NumPy arrays without copying them row by row.
+
+        Returns:
+        dict: Mapping of column name to a typed array, object arrays for columns without a type code.
+        """
+        return {
+            name: np.array(column, dtype=column.typecode) if isinstance(column, array) else np.array(column, dtype=object)
+            for name, column in zip(self.columns, self._data)
+        }
+
+    def to_frame(self, scale=None):
+        """
+        Build a DataFrame from the collected rows.
+
+        Parameters:
+        scale (dict): Optional mapping of column name to a divisor applied to the whole column.
+
+        Returns:
+        pandas.DataFrame: DataFrame with one typed column per schema entry.
+        """
+        frame = self.to_arrays()
+        for name, divisor in (scale or {}).items():
+            frame[name] = frame[name] / divisor
+        return pd.DataFrame(frame, columns=self.columns)
@@ -1,84 +1,225 @@
 import streamlit as st
 import re
-import pandas as pd
+import numpy as np
+
+# Race distances in kilometers for the prediction grid
+RACE_DISTANCES = {'1 mile': 1.609344, '5K': 5.0, '10K': 10.0, 'Half marathon': 21.0975, 'Marathon': 42.195}
+# Exponent of Riegel's formula T2 = T1 * (D2 / D1) ** exponent
+RIEGEL_EXPONENT = 1.06
+
+
+def parse_times(times):
+    """
+    Parse times in the format 'hh:mm:ss' to minutes.
+
+    Parameters:
+    times (array-like of str): Times in the format 'hh:mm:ss'.
+
+    Returns:
+    numpy.ndarray: Times in minutes.
+    """
+    times = np.asarray(times, dtype=str)
+    hours, _, rest = np.moveaxis(np.char.partition(times, ':'), -1, 0)
+    minutes, _, seconds = np.moveaxis(np.char.partition(rest, ':'), -1, 0)
+    return hours.astype(int) * 60 + minutes.astype(int) + seconds.astype(int) / 60
+
+
+def parse_paces(pace_strs):
+    """
+    Parse formatted running paces in the format 'mm:ss' (minutes:seconds) per kilometer to float paces in minutes per kilometer.
+
+    Parameters:
+    pace_strs (array-like of str): Formatted running paces in the format 'mm:ss' (minutes:seconds) per kilometer.
+
+    Returns:
+    numpy.ndarray: Running paces in minutes per kilometer.
+    """
+    pace_strs = np.asarray(pace_strs, dtype=str)
+    minutes, _, seconds = np.moveaxis(np.char.partition(pace_strs, ':'), -1, 0)
+    return minutes.astype(int) + seconds.astype(int) / 60
+
+
+def calculate_paces(distances_km, times):
+    """
+    Calculate running paces given distances in kilometers and times in the format 'hh:mm:ss'.
+
+    Parameters:
+    distances_km (array-like of float): Distances in kilometers.
+    times (array-like of str): Times in the format 'hh:mm:ss'.
+
+    Returns:
+    numpy.ndarray: Running paces in minutes per kilometer.
+    """
+    return parse_times(times) / np.asarray(distances_km, dtype=float)
+
+
+def format_paces(paces):
+    """
+    Format running paces in minutes per kilometer to the format typically seen on training watches.
+
+    Parameters:
+    paces (array-like of float): Running paces in minutes per kilometer.
+
+    Returns:
+    numpy.ndarray: Formatted running paces in the format 'mm:ss' (minutes:seconds) per kilometer.
+    """
+    paces = np.asarray(paces, dtype=float)
+    minutes = np.trunc(paces).astype(int)
+    seconds = np.trunc((paces % 1) * 60).astype(int)
+    return np.char.add(np.char.add(np.char.zfill(minutes.astype(str), 2), ':'), np.char.zfill(seconds.astype(str), 2))
+
+
+def format_times(minutes):
+    """
+    Format durations in minutes to the format 'hh:mm:ss'.
+
+    Parameters:
+    minutes (array-like of float): Durations in minutes.
+
+    Returns:
+    numpy.ndarray: Formatted durations.
+    """
+    total_seconds = np.trunc(np.asarray(minutes, dtype=float) * 60).astype(int)
+    parts = [total_seconds // 3600, total_seconds // 60 % 60, total_seconds % 60]
+    hours, mins, secs = (np.char.zfill(part.astype(str), 2) for part in parts)
+    return np.char.add(np.char.add(np.char.add(np.char.add(hours, ':'), mins), ':'), secs)
+
+
+def calculate_splits_batch(distances, split_length, paces):
+    """
+    Calculate the split positions and times for many runs at once.
+
+    Every run gets a split each split_length meters and a last one at its total distance.
+
+    Parameters:
+    distances (array-like of int): Total distances in meters.
+    split_length (int): Length of each split in meters.
+    paces (array-like of float): Running paces in minutes per kilometer.
+
+    Returns:
+    tuple: Index of the run, number of the split, split position in meters and time in minutes, one entry per split.
+    """
+    distances = np.asarray(distances, dtype=int)
+    paces = np.asarray(paces, dtype=float)
+    counts = -(-distances // split_length)
+    runs = np.repeat(np.arange(len(distances)), counts)
+    # Position of each split inside its run, counted from 1
+    numbers = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + 1
+    splits = np.minimum(numbers * split_length, distances[runs])
+    return runs, numbers, splits, splits * paces[runs] / 1000
+
+
+def predict_times(distances_km, times, targets_km, exponent=RIEGEL_EXPONENT):
+    """
+    Predict race times over many distances with Riegel's formula.
+
+    Parameters:
+    distances_km (array-like of float): Distances of the known results in kilometers.
+    times (array-like of str): Known results in the format 'hh:mm:ss'.
+    targets_km (array-like of float): Distances to predict in kilometers.
+    exponent (float): Fatigue exponent of the formula.
+
+    Returns:
+    numpy.ndarray: Predicted times in minutes, one row per known result and one column per target distance.
+    """
+    distances_km = np.asarray(distances_km, dtype=float)
+    targets_km = np.asarray(targets_km, dtype=float)
+    return parse_times(times)[:, None] * (targets_km[None, :] / distances_km[:, None]) ** exponent
+
+
+def calculate_pace(distance_km, time):
+    """
+    Calculate running pace given distance in kilometers and time in the format 'hh:mm:ss'.
+
+    Parameters:
+    distance_km (float): Distance in kilometers.
+    time (str): Time in the format 'hh:mm:ss'.
+
+    Returns:
+    float: Running pace in minutes per kilometer.
+    """
+    return float(calculate_paces([distance_km], [time])[0])
+
+
+def format_pace(pace):
+    """
+    Format a running pace in minutes per kilometer to the format typically seen on training watches.
+
+    Parameters:
+    pace (float): Running pace in minutes per kilometer.
+
+    Returns:
+    str: Formatted running pace in the format 'mm:ss' (minutes:seconds) per kilometer.
+    """
+    return str(format_paces([pace])[0])
+
+
+def parse_pace(pace_str):
+    """
+    Parse a formatted running pace in the format 'mm:ss' (minutes:seconds) per kilometer to a float pace in minutes per kilometer.
+
+    Parameters:
+    pace_str (str): Formatted running pace in the format 'mm:ss' (minutes:seconds) per kilometer.
+
+    Returns:
+    float: Running pace in minutes per kilometer.
+    """
+    return float(parse_paces([pace_str])[0])
+
+
+def calculate_splits(distance, split_length, pace_actual):
+    """
+    Calculate the time it takes to complete each split given the total distance, split length, and actual pace.
+
+    Parameters:
+    distance (int): Total distance in meters.
+    split_length (int): Length of each split in meters.
+    pace_actual (str): Actual running pace in the format 'mm:ss' (minutes:seconds) per kilometer.
+
+    Returns:
+    pandas.DataFrame: A DataFrame containing the splits and the corresponding time to complete each split.
+    """
+    import pandas as pd
+    _, numbers, splits, times = calculate_splits_batch([distance], split_length, parse_paces([pace_actual]))
+    table = pd.DataFrame({'Splits': splits, 'Time': format_paces(times)}, index=pd.Index(numbers, name='N'))
+    return table
+
+
+def calculate_batch(athletes, split_length, targets):
+    """
+    Calculate paces, splits and race predictions for a table of athletes.
+
+    Parameters:
+    athletes (pandas.DataFrame): Columns 'Athlete', 'Distance (km)' and 'Time' in the format 'hh:mm:ss'.
+    split_length (int): Length of each split in meters.
+    targets (dict): Race names and distances in kilometers for the prediction grid.
+
+    Returns:
+    tuple: DataFrames with the paces, the splits and the race predictions of every athlete.
+    """
+    import pandas as pd
+    distances = athletes['Distance (km)'].to_numpy(dtype=float)
+    times = athletes['Time'].to_numpy(dtype=str)
+    paces = calculate_paces(distances, times)
+    pace_table = athletes.assign(Pace=format_paces(paces))
+
+    runs, numbers, splits, split_times = calculate_splits_batch(np.round(distances * 1000), split_length, paces)
+    splits_table = pd.DataFrame({
+        'Athlete': athletes['Athlete'].to_numpy()[runs],
+        'N': numbers,
+        'Splits': splits,
+        'Time': format_paces(split_times),
+    })
+
+    predictions = predict_times(distances, times, list(targets.values()))
+    prediction_table = pd.DataFrame(format_times(predictions), columns=list(targets))
+    prediction_table.insert(0, 'Athlete', athletes['Athlete'].to_numpy())
+    return pace_table, splits_table, prediction_table
 
 
 def app():
     st.header(' :memo: Running calculator page')
 
-    def calculate_pace(distance_km, time):
-        """
-        Calculate running pace given distance in kilometers and time in the format 'hh:mm:ss'.
-
-        Parameters:
-        distance_km (float): Distance in kilometers.
-        time (str): Time in the format 'hh:mm:ss'.
-
-        Returns:
-        float: Running pace in minutes per kilometer.
-        """
-        hours, minutes, seconds = map(int, time.split(':'))
-        total_minutes = hours * 60 + minutes + seconds / 60
-        pace = total_minutes / distance_km
-        return pace
-
-    def format_pace(pace):
-        """
-        Format a running pace in minutes per kilometer to the format typically seen on training watches.
-
-        Parameters:
-        pace (float): Running pace in minutes per kilometer.
-
-        Returns:
-        str: Formatted running pace in the format 'mm:ss' (minutes:seconds) per kilometer.
-        """
-        minutes = int(pace)
-        seconds = int((pace % 1) * 60)
-        return f"{minutes:02d}:{seconds:02d}"
-
-    def parse_pace(pace_str):
-        """
-        Parse a formatted running pace in the format 'mm:ss' (minutes:seconds) per kilometer to a float pace in minutes per kilometer.
-
-        Parameters:
-        pace_str (str): Formatted running pace in the format 'mm:ss' (minutes:seconds) per kilometer.
-
-        Returns:
-        float: Running pace in minutes per kilometer.
-        """
-        minutes, seconds = map(int, pace_str.split(':'))
-        pace = minutes + seconds / 60
-        return pace
-
-    def calculate_splits(distance, split_length, pace_actual):
-        """
-        Calculate the time it takes to complete each split given the total distance, split length, and actual pace.
-
-        Parameters:
-        distance (int): Total distance in meters.
-        split_length (int): Length of each split in meters.
-        pace_actual (str): Actual running pace in the format 'mm:ss' (minutes:seconds) per kilometer.
-
-        Returns:
-        pandas.DataFrame: A DataFrame containing the splits and the corresponding time to complete each split.
-        """
-        splits = []
-        for i in range(split_length, distance, split_length):
-            splits.append(i)
-        if distance not in splits:
-            splits.append(distance)
-
-        table = pd.DataFrame(splits, columns=['Splits'])
-        pace = parse_pace(pace_actual)
-        table['Time'] = table['Splits'] * pace / 1000
-        table['Time'] = table['Time'].apply(format_pace)
-        table.reset_index(drop=True, inplace=True)
-        table.rename_axis('N', inplace=True)
-        table.index += 1
-
-        return table
-    
-    
     st.subheader('Pace calculator')
     # Time input
     time_input = st.text_input('Enter time (hh\:mm\:ss) :', value='00:00:00')
@@ -101,10 +242,10 @@ def app():
             st.write(f'Your pace: {formatted_pace} min/km')
         else:
             st.warning('Please enter time and distance')
-         
+
     st.markdown('<hr>', unsafe_allow_html=True) # Divider
-    
-    
+
+
     st.subheader('Splits calculator')
     # Input fields
     distance = st.number_input('Total Distance (m):', value=10000)
@@ -113,4 +254,40 @@ def app():
     # Calculate splits
     if st.button('Calculate splits'):
         table = calculate_splits(distance, split_length, pace_actual)
-        st.dataframe(table)
\ No newline at end of file
+        st.dataframe(table)
+
+    st.markdown('<hr>', unsafe_allow_html=True) # Divider
+
+
+    st.subheader('Batch calculator')
+    st.markdown('''
+    Upload a CSV file with the columns __Athlete__, __Distance (km)__ and __Time__ (hh:mm:ss)
+    to get paces, splits and race predictions for all athletes at once.
+                ''')
+    batch_file = st.file_uploader('Choose a CSV file', type=['csv'])
+    batch_split_length = st.number_input('Batch split length (m):', value=1000)
+    races = st.multiselect('Race predictions', list(RACE_DISTANCES), default=list(RACE_DISTANCES))
+    if st.button('Calculate batch'):
+        if batch_file is None:
+            st.warning('Please upload a CSV file')
+            return
+        import pandas as pd
+        athletes = pd.read_csv(batch_file, dtype={'Athlete': str, 'Time': str})
+        missing = {'Athlete', 'Distance (km)', 'Time'} - set(athletes.columns)
+        if missing:
+            st.warning(f'Missing columns: {", ".join(sorted(missing))}')
+            return
+        athletes['Distance (km)'] = pd.to_numeric(athletes['Distance (km)'], errors='coerce')
+        # Check time format of every row using regular expression
+        invalid = ~athletes['Time'].str.fullmatch(r'\d{2}:\d{2}:\d{2}', na=False) | ~(athletes['Distance (km)'] > 0)
+        if invalid.any():
+            st.warning(f'Skipping {invalid.sum()} rows with incorrect time format or distance')
+            athletes = athletes.loc[~invalid].reset_index(drop=True)
+        pace_table, splits_table, prediction_table = calculate_batch(
+            athletes, batch_split_length, {race: RACE_DISTANCES[race] for race in races})
+        for title, table, name in [('Paces', pace_table, 'paces.csv'),
+                                   ('Splits', splits_table, 'splits.csv'),
+                                   ('Race predictions', prediction_table, 'predictions.csv')]:
+            st.write(title)
+            st.dataframe(table)
+            st.download_button(f'Download {name}', table.to_csv(index=False), file_name=name, mime='text/csv')
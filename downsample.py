@@ -0,0 +1,80 @@
+import numpy as np
+from zones import MIN_MOVING_SPEED
+
+# Points kept per chart series, enough for the width of a chart and light enough for the browser
+POINT_BUDGET = 1000
+# Series of the activity detail view with the track column they come from and their axis title
+SERIES = {
+    'pace': ('speed', 'Pace (min/km)'),
+    'heart_rate': ('heart_rate', 'Heart rate (bpm)'),
+    'altitude': ('altitude', 'Elevation (m)'),
+}
+
+
+def lttb(x, y, threshold):
+    """
+    Pick the points of a series that keep its shape with Largest-Triangle-Three-Buckets.
+
+    The first and last points are kept and the others are split into threshold - 2 buckets of
+    equal size. From each bucket the point forming the largest triangle with the point picked in
+    the previous bucket and the mean of the next bucket is kept, so peaks and drops survive
+    where plain decimation would skip them. Bucket means are computed at once from cumulative sums.
+
+    Parameters:
+    x (numpy.ndarray): Increasing x values.
+    y (numpy.ndarray): y values, without NaN.
+    threshold (int): Number of points to keep.
+
+    Returns:
+    numpy.ndarray: Sorted indices of the kept points, every index when the series is not longer than threshold.
+    """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    # Bucket b holds the points from edges[b] to edges[b + 1], the first and last points are left out
+    edges = (np.arange(threshold - 1) * ((n - 2) / (threshold - 2))).astype(np.int64) + 1
+    edges[-1] = n - 1
+    cx = np.concatenate([[0.0], np.cumsum(x)])
+    cy = np.concatenate([[0.0], np.cumsum(y)])
+    sizes = np.diff(edges)
+    mean_x = (cx[edges[1:]] - cx[edges[:-1]]) / sizes
+    mean_y = (cy[edges[1:]] - cy[edges[:-1]]) / sizes
+    # The bucket after the last one is the last point
+    mean_x = np.append(mean_x[1:], x[-1])
+    mean_y = np.append(mean_y[1:], y[-1])
+    kept = np.empty(threshold, dtype=np.int64)
+    kept[0], kept[-1] = 0, n - 1
+    a = 0
+    for b in range(threshold - 2):
+        start, end = edges[b], edges[b + 1]
+        # Twice the triangle area, the factor does not change the largest one
+        area = np.abs((x[a] - mean_x[b]) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (mean_y[b] - y[a]))
+        a = start + int(np.argmax(area))
+        kept[b + 1] = a
+    return kept
+
+
+def track_series(track, points=POINT_BUDGET):
+    """
+    Downsample the pace, heart rate and elevation of a track for the activity detail view.
+
+    Parameters:
+    track (dict): Output of tracks.read_track.
+    points (int): Points kept per series.
+
+    Returns:
+    dict: Mapping of each SERIES name to a pair of float32 arrays, minutes since the start and values.
+    """
+    minutes = (track['timestamp'] - track['timestamp'][0]) / 60 if len(track['timestamp']) else track['timestamp']
+    series = {}
+    for name, (column, _) in SERIES.items():
+        values = track[column].astype(float)
+        if name == 'pace':
+            # Pace is not defined when standing still
+            values = np.where(values >= MIN_MOVING_SPEED, 1000 / 60 / np.maximum(values, MIN_MOVING_SPEED), np.nan)
+        valid = np.flatnonzero(~np.isnan(values))
+        kept = valid[lttb(minutes[valid], values[valid], points)]
+        series[name] = (minutes[kept].astype(np.float32), values[kept].astype(np.float32))
+    return series
@@ -0,0 +1,83 @@
+import numpy as np
+import pandas as pd
+
+# Distances in meters of the best efforts looked for in every activity
+EFFORT_DISTANCES = {'1K': 1000, '5K': 5000, '10K': 10000, 'Half marathon': 21097.5}
+
+
+def best_efforts(distance, timestamp, targets):
+    """
+    Find the fastest time over each target distance within one activity.
+
+    For every record the end of the window is the first record at least the target distance
+    further. The cumulative distance never decreases, so the window end only moves forward as the
+    start does (a two-pointer sweep), found for all starts at once with np.searchsorted. The time
+    at which the target distance is reached is interpolated between the two records around it.
+
+    Parameters:
+    distance (numpy.ndarray): Cumulative distance in meters of each record, NaN where missing.
+    timestamp (numpy.ndarray): POSIX timestamp of each record.
+    targets (array-like): Target distances in meters.
+
+    Returns:
+    numpy.ndarray: Best elapsed time in seconds for each target, NaN for targets longer than the activity.
+    """
+    valid = ~np.isnan(distance)
+    # GPS corrections can make the recorded distance go back a little
+    d = np.maximum.accumulate(distance[valid])
+    t = timestamp[valid]
+    times = np.full(len(targets), np.nan, dtype=np.float32)
+    for k, target in enumerate(targets):
+        if len(d) < 2 or d[-1] - d[0] < target:
+            continue
+        end = np.searchsorted(d, d + target, side='left')
+        start = np.flatnonzero(end < len(d))
+        end = end[start]
+        previous = end - 1
+        span = d[end] - d[previous]
+        fraction = np.divide(d[start] + target - d[previous], span, out=np.ones_like(span), where=span > 0)
+        times[k] = np.min(t[previous] + fraction * (t[end] - t[previous]) - t[start])
+    return times
+
+
+def efforts_per_activity(df, filenames, efforts):
+    """
+    Join the best efforts of activities with their activities.csv data.
+
+    Parameters:
+    df (pandas.DataFrame): Activities.
+    filenames (list): 'Filename' of each row of efforts.
+    efforts (numpy.ndarray): Best times in seconds, one row per activity and one column per EFFORT_DISTANCES entry.
+
+    Returns:
+    pandas.DataFrame: Name, date and type of each activity with its best time in seconds per distance.
+    """
+    times = pd.DataFrame(efforts, columns=list(EFFORT_DISTANCES)).assign(Filename=filenames)
+    columns = ['Filename', 'Activity Name', 'Activity Date', 'Activity Type']
+    return pd.merge(df[columns], times, how='inner', on='Filename')
+
+
+def personal_records(activity_efforts):
+    """
+    Pick the fastest effort over each distance.
+
+    Parameters:
+    activity_efforts (pandas.DataFrame): Output of efforts_per_activity.
+
+    Returns:
+    pandas.DataFrame: One row per distance reached by any activity with the time in seconds,
+    the pace in minutes per kilometer and the activity it was run in.
+    """
+    records = []
+    for name, meters in EFFORT_DISTANCES.items():
+        times = activity_efforts[name]
+        if times.notna().any():
+            best = activity_efforts.loc[times.idxmin()]
+            records.append({
+                'Distance': name,
+                'Seconds': best[name],
+                'Pace (min/km)': best[name] / 60 / (meters / 1000),
+                'Activity Name': best['Activity Name'],
+                'Activity Date': best['Activity Date'],
+            })
+    return pd.DataFrame(records, columns=['Distance', 'Seconds', 'Pace (min/km)', 'Activity Name', 'Activity Date'])
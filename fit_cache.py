@@ -0,0 +1,206 @@
+import hashlib
+import os
+import sqlite3
+import time
+
+# Directory for data kept between runs, can be moved with an environment variable
+CACHE_DIR = os.environ.get('RUNNING_HELPER_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'running-helper'))
+# Bump when the layout or meaning of cached values changes, older caches are dropped
+SCHEMA_VERSION = 3
+
+
+def content_hash(data):
+    """
+    Hash the raw bytes of an archive member so identical files share one cache entry.
+
+    Parameters:
+    data (bytes): Raw member bytes.
+
+    Returns:
+    str: Hex digest of the content.
+    """
+    return hashlib.blake2b(data, digest_size=20).hexdigest()
+
+
+class SqliteCache:
+    """
+    Base of the persistent SQLite caches keyed by the file content hash.
+
+    Subclasses name their TABLE and list its COLUMNS after the hash. When the cache holds more
+    than max_entries rows the least recently used ones are evicted.
+    """
+
+    TABLE = None
+    COLUMNS = None
+    FILENAME = None
+
+    def __init__(self, path=None, max_entries=200_000):
+        if path is None:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            path = os.path.join(CACHE_DIR, self.FILENAME)
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        # Batch workers share the cache file, so wait for each other's writes
+        self.connection = sqlite3.connect(path, timeout=30)
+        # A lost write only means decoding a file again, so do not wait for the disk on every commit
+        self.connection.executescript('PRAGMA journal_mode = WAL; PRAGMA synchronous = NORMAL;')
+        if self.connection.execute('PRAGMA user_version').fetchone()[0] != SCHEMA_VERSION:
+            self.connection.executescript(f'''
+                DROP TABLE IF EXISTS {self.TABLE};
+                PRAGMA user_version = {SCHEMA_VERSION};
+            ''')
+        columns = ''.join(f'{column},\n' for column in self.COLUMNS)
+        self.connection.executescript(f'''
+            CREATE TABLE IF NOT EXISTS {self.TABLE} (
+                hash TEXT PRIMARY KEY,
+                {columns}
+                last_used REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS {self.TABLE}_last_used ON {self.TABLE} (last_used);
+        ''')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def __len__(self):
+        return self.connection.execute(f'SELECT COUNT(*) FROM {self.TABLE}').fetchone()[0]
+
+    def _select(self, columns, hashes):
+        """
+        Look up rows and mark them as recently used.
+
+        Parameters:
+        columns (list): Columns to read besides the hash.
+        hashes (list): Content hashes to look up.
+
+        Returns:
+        dict: Mapping of found hash to a tuple of the column values.
+        """
+        found = {}
+        # Stay below SQLite's limit on the number of query parameters
+        for i in range(0, len(hashes), 500):
+            batch = hashes[i:i + 500]
+            rows = self.connection.execute(
+                f'SELECT hash, {", ".join(columns)} FROM {self.TABLE} WHERE hash IN ({",".join("?" * len(batch))})',
+                batch,
+            )
+            for h, *values in rows:
+                found[h] = tuple(values)
+        if found:
+            now = time.time()
+            with self.connection:
+                self.connection.executemany(f'UPDATE {self.TABLE} SET last_used = ? WHERE hash = ?', [(now, h) for h in found])
+        self.hits += len(found)
+        self.misses += len(hashes) - len(found)
+        return found
+
+    def put_many(self, entries):
+        """
+        Store entries and evict the least recently used ones above the size bound.
+
+        Parameters:
+        entries (list): Tuples of the hash followed by a value for each of COLUMNS.
+        """
+        now = time.time()
+        names = ['hash', *(column.split()[0] for column in self.COLUMNS), 'last_used']
+        with self.connection:
+            self.connection.executemany(
+                f'INSERT OR REPLACE INTO {self.TABLE} ({", ".join(names)}) VALUES ({", ".join("?" * len(names))})',
+                [(*entry, now) for entry in entries],
+            )
+            excess = len(self) - self.max_entries
+            if excess > 0:
+                self.connection.execute(
+                    f'DELETE FROM {self.TABLE} WHERE hash IN (SELECT hash FROM {self.TABLE} ORDER BY last_used, rowid LIMIT ?)',
+                    (excess,),
+                )
+
+    def stats(self):
+        """
+        Report cache counters.
+
+        Returns:
+        dict: Number of hits, misses and entries and the hit rate.
+        """
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self),
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+
+class FitCache(SqliteCache):
+    """
+    Persistent SQLite cache of decoded FIT start records keyed by the file content hash.
+
+    Coordinates are stored as raw semicircles, the same way the decode workers return them.
+    Files without a position are cached too (with empty coordinates) so they are not decoded again.
+    Summary fields (distance, times, heart rate) are not cached, activities.csv already has them
+    and the FIT session message holding them is only reached by decoding the whole file.
+    """
+
+    TABLE = 'fit_start'
+    COLUMNS = ['timestamp REAL', 'lat INTEGER', 'long INTEGER']
+    FILENAME = 'fit_cache.sqlite'
+
+    def get_many(self, hashes):
+        """
+        Look up cached start records and mark them as recently used.
+
+        Parameters:
+        hashes (list): Content hashes to look up.
+
+        Returns:
+        dict: Mapping of found hash to a (timestamp, lat, long) tuple, values are None for files without a position.
+        """
+        return self._select(['timestamp', 'lat', 'long'], hashes)
+
+
+class TrackCache(SqliteCache):
+    """
+    Persistent SQLite cache of full resolution tracks and their summaries keyed by the file content hash.
+
+    Tracks are kept as compressed column arrays (see tracks.pack_track), the summaries as raw
+    float32 bytes, so the analytics never have to unpack a track.
+    """
+
+    TABLE = 'track'
+    COLUMNS = ['hr_seconds BLOB', 'speed_seconds BLOB', 'best_efforts BLOB', 'data BLOB']
+    FILENAME = 'track_cache.sqlite'
+
+    def __init__(self, path=None, max_entries=20_000):
+        super().__init__(path, max_entries)
+
+    def get_summaries(self, hashes):
+        """
+        Look up the summaries of cached tracks.
+
+        Parameters:
+        hashes (list): Content hashes to look up.
+
+        Returns:
+        dict: Mapping of found hash to a tuple of bytes in tracks.SUMMARIES order, None for files that could not be read.
+        """
+        return self._select(['hr_seconds', 'speed_seconds', 'best_efforts'], hashes)
+
+    def get_track(self, h):
+        """
+        Look up one packed track.
+
+        Parameters:
+        h (str): Content hash.
+
+        Returns:
+        bytes or None: Packed track, None when it is not cached or the file could not be read.
+        """
+        return self._select(['data'], [h]).get(h, (None,))[0]
@@ -0,0 +1,227 @@
+import numpy as np
+
+# Grid cell sizes in degrees tried from the finest to the coarsest, about 100 m to 500 km at the equator
+CELL_SIZES = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0]
+# Upper bound of markers sent to the browser, whatever the length of the history
+MAX_MARKERS = 1500
+
+
+def grid_keys(lat, long, cell_size):
+    """
+    Number the grid cells holding each point.
+
+    Parameters:
+    lat (numpy.ndarray): Latitudes in degrees.
+    long (numpy.ndarray): Longitudes in degrees.
+    cell_size (float): Cell size in degrees.
+
+    Returns:
+    numpy.ndarray: One int64 cell number per point.
+    """
+    columns = int(np.ceil(360 / cell_size)) + 1
+    rows = np.floor((lat + 90) / cell_size).astype(np.int64)
+    return rows * columns + np.floor((long + 180) / cell_size).astype(np.int64)
+
+
+def choose_cell_size(lat, long, groups, max_markers=MAX_MARKERS):
+    """
+    Pick the finest grid that needs no more than max_markers markers.
+
+    Parameters:
+    lat (numpy.ndarray): Latitudes in degrees.
+    long (numpy.ndarray): Longitudes in degrees.
+    groups (numpy.ndarray): Integer code of the group of each point, markers are never shared between groups.
+    max_markers (int): Upper bound of markers.
+
+    Returns:
+    float: Cell size in degrees, the coarsest one of CELL_SIZES if none is small enough.
+    """
+    n_groups = int(groups.max()) + 1 if len(groups) else 1
+    for cell_size in CELL_SIZES:
+        if len(np.unique(grid_keys(lat, long, cell_size) * n_groups + groups)) <= max_markers:
+            return cell_size
+    return CELL_SIZES[-1]
+
+
+def bin_activities(cdf, max_markers=MAX_MARKERS):
+    """
+    Collapse the start points of activities of each type into one weighted marker per grid cell.
+
+    The grid gets coarser until there are at most max_markers markers (or the coarsest grid is reached),
+    so the map payload stays bounded however many activities there are.
+
+    Parameters:
+    cdf (pandas.DataFrame): Activities with coordinates.
+    max_markers (int): Upper bound of markers.
+
+    Returns:
+    tuple: DataFrame with one row per marker and the cell size in degrees. Markers sit at the
+    centroid of their activities and carry their count, total distance, average speed, elevation gain, date range
+    and the name of the first activity.
+    """
+    lat = cdf['lat'].to_numpy(dtype=float)
+    long = cdf['long'].to_numpy(dtype=float)
+    types = cdf['Activity Type'].astype('category')
+    groups = types.cat.codes.to_numpy(dtype=np.int64)
+    cell_size = choose_cell_size(lat, long, groups, max_markers)
+    keys = grid_keys(lat, long, cell_size) * (len(types.cat.categories) or 1) + groups
+    markers = cdf.assign(cell=keys, **{'Activity Type': types}).groupby('cell', sort=False).agg(
+        lat=('lat', 'mean'),
+        long=('long', 'mean'),
+        activity_type=('Activity Type', 'first'),
+        count=('lat', 'size'),
+        total_distance_km=('Distance (km)', 'sum'),
+        avg_speed=('Average Speed (km/hr)', 'mean'),
+        total_elevation_gain=('Elevation Gain', 'sum'),
+        first_date=('Activity Date', 'min'),
+        last_date=('Activity Date', 'max'),
+        name=('Activity Name', 'first'),
+    ).rename(columns={'activity_type': 'Activity Type'}).reset_index(drop=True)
+    # A marker of a single activity is labeled with its name
+    markers['label'] = markers['name'].where(markers['count'] == 1, markers['count'].astype(str) + ' activities')
+    return markers, cell_size
+
+
+# Kilometers per degree of latitude
+KM_PER_DEGREE = 111.195
+# Side in kilometers of the grid cells of SpatialIndex, activities starting in the same cell are at the same place
+PLACE_KM = 1.0
+
+
+def haversine_km(lat, long, lat0, long0):
+    """
+    Compute great circle distances to one point.
+
+    Parameters:
+    lat (numpy.ndarray): Latitudes in degrees.
+    long (numpy.ndarray): Longitudes in degrees.
+    lat0 (float): Latitude of the point in degrees.
+    long0 (float): Longitude of the point in degrees.
+
+    Returns:
+    numpy.ndarray: Distances in kilometers.
+    """
+    lat, long, lat0, long0 = np.radians(lat), np.radians(long), np.radians(lat0), np.radians(long0)
+    a = np.sin((lat - lat0) / 2) ** 2 + np.cos(lat) * np.cos(lat0) * np.sin((long - long0) / 2) ** 2
+    return 2 * KM_PER_DEGREE * 180 / np.pi * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+class SpatialIndex:
+    """
+    Grid index over the start points of activities, built once per dataset.
+
+    Points are numbered by the grid_keys cell of PLACE_KM holding them and sorted by that number,
+    so the points of a run of cells along one row of the grid are a contiguous slice found with
+    np.searchsorted. A radius query only measures the distance of the points in the rows and
+    columns of cells around the circle. Cells double as places: the visits of every cell are
+    counted once when the index is built, the place queries only filter and sort that table.
+    """
+
+    def __init__(self, cdf, place_km=PLACE_KM):
+        self.cdf = cdf.reset_index(drop=True)
+        self.cell_size = place_km / KM_PER_DEGREE
+        self.columns = int(np.ceil(360 / self.cell_size)) + 1
+        lat = self.cdf['lat'].to_numpy(dtype=float)
+        long = self.cdf['long'].to_numpy(dtype=float)
+        keys = grid_keys(lat, long, self.cell_size)
+        self.order = np.argsort(keys, kind='stable')
+        self.keys = keys[self.order]
+        self.lat = lat[self.order]
+        self.long = long[self.order]
+        # Positions are sorted by key, the name and date of a place come from its latest activity
+        latest = self.cdf.iloc[self.order].assign(place=self.keys).sort_values('Activity Date', kind='stable')
+        self.places = latest.groupby('place').agg(
+            lat=('lat', 'mean'),
+            long=('long', 'mean'),
+            visits=('lat', 'size'),
+            first_visit=('Activity Date', 'min'),
+            last_visit=('Activity Date', 'max'),
+            name=('Activity Name', 'last'),
+            total_distance_km=('Distance (km)', 'sum'),
+        )
+
+    def __len__(self):
+        return len(self.keys)
+
+    def within(self, lat, long, radius_km):
+        """
+        Find the activities starting within radius_km of a point.
+
+        Parameters:
+        lat (float): Latitude of the point in degrees.
+        long (float): Longitude of the point in degrees.
+        radius_km (float): Radius in kilometers.
+
+        Returns:
+        pandas.DataFrame: Activities sorted from the closest one, with their 'Distance from point (km)'.
+        """
+        lat_span = radius_km / KM_PER_DEGREE
+        # Meridians get closer towards the poles, the widest longitude span is at the edge nearest to a pole
+        edge = min(abs(lat) + lat_span, 90.0)
+        cos_edge = np.cos(np.radians(edge))
+        rows = np.floor((np.array([lat - lat_span, lat + lat_span]).clip(-90, 90) + 90) / self.cell_size).astype(np.int64)
+        if cos_edge * 180 <= lat_span or rows[1] - rows[0] > len(self.keys):
+            # The circle covers a pole or the whole longitude range, or more rows than points
+            candidates = np.arange(len(self.keys))
+        else:
+            long_span = lat_span / cos_edge
+            first = np.floor((long - long_span + 180) / self.cell_size).astype(np.int64)
+            last = np.floor((long + long_span + 180) / self.cell_size).astype(np.int64)
+            row_keys = np.arange(rows[0], rows[1] + 1) * self.columns
+            # Cells past the antimeridian are taken from the other end of the row, widened by one cell
+            # as 360 degrees is not a whole number of cells
+            wrap = int(round(360 / self.cell_size))
+            spans = [(max(low, 0), min(high, self.columns - 1))
+                     for low, high in [(first, last), (first + wrap - 1, last + wrap + 1), (first - wrap - 1, last - wrap + 1)]]
+            spans = [(low, high) for low, high in spans if low <= high]
+            starts = np.searchsorted(self.keys, np.concatenate([row_keys + low for low, _ in spans]), side='left')
+            ends = np.searchsorted(self.keys, np.concatenate([row_keys + high for _, high in spans]), side='right')
+            candidates = np.unique(np.concatenate([np.arange(s, e) for s, e in zip(starts, ends) if e > s] or [np.arange(0)]))
+        distances = haversine_km(self.lat[candidates], self.long[candidates], lat, long)
+        inside = distances <= radius_km
+        found = np.argsort(distances[inside], kind='stable')
+        positions = self.order[candidates[inside][found]]
+        return self.cdf.iloc[positions].assign(**{'Distance from point (km)': distances[inside][found]})
+
+    def most_visited(self, n=10, since=None):
+        """
+        Rank places by the number of activities started there.
+
+        Parameters:
+        n (int): Number of places.
+        since (pandas.Timestamp): Only count places with a visit since then, all places if None.
+
+        Returns:
+        pandas.DataFrame: Places indexed by their cell number, with their centroid, visits,
+        first and last visit, name of the latest activity and total distance.
+        """
+        places = self.places if since is None else self.places.loc[self.places['last_visit'] >= since]
+        return places.sort_values(['visits', 'last_visit'], ascending=False).head(n)
+
+    def new_places(self, start, end=None):
+        """
+        List the places visited for the first time in a period.
+
+        Parameters:
+        start (pandas.Timestamp): Start of the period.
+        end (pandas.Timestamp): End of the period, excluded, open ended if None.
+
+        Returns:
+        pandas.DataFrame: Places as in most_visited, from the most recently discovered one.
+        """
+        first = self.places['first_visit']
+        found = first >= start if end is None else (first >= start) & (first < end)
+        return self.places.loc[found].sort_values('first_visit', ascending=False)
+
+    def place_activities(self, place):
+        """
+        List the activities started at one place.
+
+        Parameters:
+        place (int): Cell number of the place, the index of the place tables.
+
+        Returns:
+        pandas.DataFrame: Activities from the most recent one.
+        """
+        start, end = np.searchsorted(self.keys, [place, place + 1], side='left')
+        return self.cdf.iloc[self.order[start:end]].sort_values('Activity Date', ascending=False)
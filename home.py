@@ -11,6 +11,10 @@ def app():
         + :triangular_ruler: &nbsp; what distance you've covered in each of your sport types
         + :hourglass_flowing_sand: &nbsp; how many hours you spend in each of your sport types
         + :world_map: &nbsp; find interesting locations of you training sessions
-    - training - page where you can diversify your everyday training routine
+        + :round_pushpin: &nbsp; your most visited places, new places each month and activities around any point
+        + :heartpulse: &nbsp; how much time you spend in each heart rate and pace zone
+        + :trophy: &nbsp; your fastest 1K, 5K, 10K and half marathon efforts
+        + :chart_with_upwards_trend: &nbsp; pace, heart rate and elevation along any single activity
+    - training - page where you can diversify your everyday training routine, with the session type and duration fitted to your training load
     - calculator - page where you can calculate valuable parameters for your runs and races
                 ''')
\ No newline at end of file
@@ -0,0 +1,76 @@
+import json
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+
+def max_rss_mb():
+    """
+    Get the peak resident set size of the current process.
+
+    Returns:
+    float or None: Peak RSS in megabytes, None where the platform does not report it.
+    """
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2**20 if sys.platform == 'darwin' else 2**10)
+
+
+class Trace:
+    """
+    Collects wall time, CPU time, memory and processed counts of named pipeline stages.
+
+    Stages are flat, each one is a context manager yielding a dict where the stage can store
+    counts such as rows or files. Memory tracing with tracemalloc is opt-in as it slows the code down.
+    """
+
+    def __init__(self, track_memory=False):
+        self.track_memory = track_memory
+        self.created = time.strftime('%Y-%m-%dT%H:%M:%S')
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name):
+        record = {'stage': name}
+        started = False
+        # Turning tracking off while a stage runs takes effect from the next stage
+        track_memory = self.track_memory
+        if track_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                started = True
+            tracemalloc.reset_peak()
+            before, _ = tracemalloc.get_traced_memory()
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield record
+        finally:
+            record['wall_seconds'] = time.perf_counter() - wall
+            # CPU time of this process only, worker processes are not included
+            record['cpu_seconds'] = time.process_time() - cpu
+            if track_memory:
+                _, peak = tracemalloc.get_traced_memory()
+                record['peak_mb'] = (peak - before) / 2**20
+                if started:
+                    tracemalloc.stop()
+            record['max_rss_mb'] = max_rss_mb()
+            self.stages.append(record)
+
+    def total_seconds(self):
+        return sum(record['wall_seconds'] for record in self.stages)
+
+    def to_json(self):
+        """
+        Export the trace for offline analysis.
+
+        Returns:
+        str: JSON document with the creation time and every recorded stage.
+        """
+        return json.dumps({'created': self.created, 'track_memory': self.track_memory, 'stages': self.stages}, indent=2)
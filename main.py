@@ -1,6 +1,6 @@
+import importlib
 import streamlit as st
 from streamlit_option_menu import option_menu
-import home, strava, training, calculator
 
 st.set_page_config(page_title='Running-helper space',
                    page_icon=':running:')
@@ -18,19 +18,37 @@ class MultiApp:
     def __init__(self):
         self.apps = []
 
-    def add_app(self, title, func):
+    def add_app(self, title, module, icon):
+        """
+        Register a page without importing it.
 
+        Parameters:
+        title (str): Title shown in the app menu.
+        module (str): Name of the page module with an app() function.
+        icon (str): Bootstrap icon name shown next to the title.
+        """
         self.apps.append({
             'title': title,
-            'function': func
+            'module': module,
+            'icon': icon,
         })
 
-    def run():
+    def load(self, title):
+        """
+        Import the page module on its first selection.
+
+        import_module keeps the module in sys.modules, so later selections and reruns reuse it
+        and the heavy dependencies of a page are only paid for when it is opened.
+        """
+        app = next(app for app in self.apps if app['title'] == title)
+        return importlib.import_module(app['module'])
+
+    def run(self):
         with st.sidebar:        
             app = option_menu(
                 menu_title='App Menu',
-                options=['home', 'strava', 'training', 'calculator'],
-                icons=['house', 'graph-up-arrow', 'calendar2-week', 'calculator'],
+                options=[app['title'] for app in self.apps],
+                icons=[app['icon'] for app in self.apps],
                 menu_icon='gear',
                 default_index=0,
                 styles={
@@ -38,14 +56,24 @@ class MultiApp:
         'icon': {'color': 'white', 'font-size': '23px'}, 
         'nav-link': {'color':'white','font-size': '20px', 'text-align': 'left', 'margin':'0px', '--hover-color': 'blue'},
         'nav-link-selected': {'background-color': '#02ab21'},})
+            # Opt-in timing and memory trace of the pages that record one
+            st.checkbox('Debug mode', key='debug')
+        debug_panel = st.sidebar.container()
+        st.session_state.pop('trace', None)
+
+        self.load(app or self.apps[0]['title']).app()
+
+        trace = st.session_state.get('trace')
+        if st.session_state.get('debug') and trace is not None:
+            with debug_panel.expander('Debug trace', expanded=True):
+                st.write(f'Last run: {trace.total_seconds():.2f} s over {len(trace.stages)} stages')
+                st.dataframe(trace.stages)
+                st.download_button('Download JSON trace', trace.to_json(), file_name='trace.json', mime='application/json')
+
 
-        if app == 'home':
-            home.app()
-        if app == 'strava':
-            strava.app()
-        if app == 'training':
-            training.app() 
-        if app == 'calculator':
-            calculator.app()            
-    
-    run()
\ No newline at end of file
+multi_app = MultiApp()
+multi_app.add_app('home', 'home', 'house')
+multi_app.add_app('strava', 'strava', 'graph-up-arrow')
+multi_app.add_app('training', 'training', 'calendar2-week')
+multi_app.add_app('calculator', 'calculator', 'calculator')
+multi_app.run()
\ No newline at end of file
@@ -0,0 +1,452 @@
+import csv as csv_module
+import os
+import zipfile
+from contextlib import nullcontext
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+from activity_files import ACTIVITY_SUFFIXES, FIT_CHUNKSIZE, FIT_WORKERS, decode_start_records, match_members
+from aggregation import TIME_UNITS, build_rollups, build_totals, rollups_from_totals, update_totals
+from athlete_store import ROW_HASH, diff_activities, row_hashes
+from instrument import Trace
+from training_load import build_training_load, update_training_load
+
+try:
+    import pyarrow as pa
+    from pyarrow import csv as pa_csv
+    ARROW_TYPES = {
+        'int64': pa.int64(),
+        'str': pa.string(),
+        'category': pa.dictionary(pa.int32(), pa.string()),
+        'float32': pa.float32(),
+        'float64': pa.float64(),
+    }
+except ImportError:
+    pa = None
+
+# Columns of activities.csv used by the app
+USECOLS = ['Activity ID', 'Activity Date', 'Activity Name', 'Activity Type', 'Max Heart Rate', 'Relative Effort',
+           'Filename', 'Moving Time', 'Distance.1', 'Elevation Gain', 'Average Heart Rate']
+# Explicit dtypes of the columns, dates are parsed separately
+CSV_DTYPES = {
+    'Activity ID': 'int64',
+    'Activity Date': 'str',
+    'Activity Name': 'str',
+    'Activity Type': 'category',
+    'Max Heart Rate': 'float32',
+    'Relative Effort': 'float32',
+    'Filename': 'str',
+    'Moving Time': 'float64',
+    'Distance.1': 'float64',
+    'Elevation Gain': 'float32',
+    'Average Heart Rate': 'float32',
+}
+# Format of 'Activity Date' in English Strava exports
+DATE_FORMAT = '%b %d, %Y, %I:%M:%S %p'
+# Files above this size are read in chunks of CSV_CHUNKSIZE rows
+LARGE_CSV_BYTES = 256 * 2**20
+CSV_CHUNKSIZE = 100_000
+# Columns added to the activities by the FIT decode stage
+COORD_COLUMNS = ['timestamp', 'lat', 'long']
+
+
+def csv_header(f):
+    """
+    Read the header line of an opened activities.csv and name duplicated columns the way pandas does.
+
+    Strava exports have two 'Distance' columns, the second one (in meters) becomes 'Distance.1'.
+
+    Parameters:
+    f (file-like): activities.csv opened in binary mode, left positioned after the header.
+
+    Returns:
+    list: Column names.
+    """
+    names = []
+    for name in next(csv_module.reader([f.readline().decode('utf-8-sig')])):
+        mangled, i = name, 0
+        while mangled in names:
+            i += 1
+            mangled = f'{name}.{i}'
+        names.append(mangled)
+    return names
+
+
+def parse_activity_dates(dates):
+    """
+    Parse 'Activity Date' values, using the known format of English exports and falling back to inference.
+
+    Parameters:
+    dates (pandas.Series): Dates as strings.
+
+    Returns:
+    pandas.Series: Parsed dates.
+    """
+    try:
+        return pd.to_datetime(dates, format=DATE_FORMAT)
+    except ValueError:
+        return pd.to_datetime(dates)
+
+
+def read_activities_arrow(f):
+    """
+    Read activities.csv with the Arrow CSV reader, parsing types and dates while reading.
+
+    Parameters:
+    f (file-like): activities.csv opened in binary mode.
+
+    Returns:
+    pandas.DataFrame: Raw activities.
+    """
+    names = csv_header(f)
+    column_types = {name: ARROW_TYPES[dtype] for name, dtype in CSV_DTYPES.items()}
+    column_types['Activity Date'] = pa.timestamp('s')
+    table = pa_csv.read_csv(
+        f,
+        read_options=pa_csv.ReadOptions(column_names=names),
+        convert_options=pa_csv.ConvertOptions(
+            include_columns=USECOLS,
+            column_types=column_types,
+            timestamp_parsers=[DATE_FORMAT],
+            strings_can_be_null=True,
+        ),
+    )
+    df = table.to_pandas()
+    df['Activity Date'] = df['Activity Date'].astype('datetime64[ns]')
+    return df
+
+
+def read_activities_pandas(f, chunksize=None):
+    """
+    Read activities.csv with the pandas C engine, in chunks of chunksize rows if given.
+
+    Categories of each chunk are unified before the chunks are concatenated, so the
+    string columns are never held as Python objects for the whole file.
+
+    Parameters:
+    f (file-like): activities.csv opened in binary mode.
+    chunksize (int): Number of rows per chunk.
+
+    Returns:
+    pandas.DataFrame: Raw activities.
+    """
+    reader = pd.read_csv(f, usecols=USECOLS, dtype=CSV_DTYPES, header=0, chunksize=chunksize)
+    frames = [reader] if chunksize is None else list(reader)
+    for frame in frames:
+        frame['Activity Date'] = parse_activity_dates(frame['Activity Date'])
+    if len(frames) == 1:
+        return frames[0]
+    for column, dtype in CSV_DTYPES.items():
+        if dtype == 'category':
+            categories = union_categoricals([frame[column] for frame in frames]).categories
+            for frame in frames:
+                frame[column] = frame[column].cat.set_categories(categories)
+    return pd.concat(frames, ignore_index=True)
+
+
+def read_activities(csv, chunksize=None):
+    """
+    Read the columns of activities.csv used by the app with an explicit dtype schema.
+
+    The Arrow CSV reader is used where available, very large files are read in chunks.
+
+    Parameters:
+    csv (str or file-like): Path to activities.csv or a file opened in binary mode.
+    chunksize (int): Read in chunks of this many rows, by default only files above LARGE_CSV_BYTES are.
+
+    Returns:
+    pandas.DataFrame: Raw activities.
+    """
+    if chunksize is None and isinstance(csv, (str, os.PathLike)) and os.path.getsize(csv) > LARGE_CSV_BYTES:
+        chunksize = CSV_CHUNKSIZE
+    with (open(csv, 'rb') if isinstance(csv, (str, os.PathLike)) else nullcontext(csv)) as f:
+        if pa is not None and chunksize is None:
+            start = f.tell()
+            try:
+                return read_activities_arrow(f)
+            except (pa.ArrowInvalid, KeyError):
+                # Dates in another format, let pandas infer them
+                f.seek(start)
+        return read_activities_pandas(f, chunksize)
+
+
+def read_export_activities(zip_path, csv=None):
+    """
+    Read activities.csv of an export, from inside the archive when it is not given separately.
+
+    Parameters:
+    zip_path (str or file-like): Strava export archive.
+    csv (str or file-like): activities.csv.
+
+    Returns:
+    pandas.DataFrame: Raw activities.
+    """
+    if csv is not None:
+        return read_activities(csv)
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        members = match_members(zip_ref, ['activities.csv'])
+        if not members:
+            raise FileNotFoundError(f'activities.csv not found in {zip_path}')
+        with zip_ref.open(members['activities.csv']) as f:
+            return read_activities(f)
+
+
+def add_derived_columns(df):
+    """
+    Add period columns and unit conversions to the raw activities in place.
+
+    Parameters:
+    df (pandas.DataFrame): Raw activities.
+
+    Returns:
+    pandas.DataFrame: Activities with 'Day' to 'Year' period columns, distance in km, time in hours and average speed.
+    """
+    # Add day, week, month, quarter, year columns
+    names = ['Day', 'Week', 'Month', 'Quarter', 'Year']
+    periods = ['D', 'W', 'M', 'Q', 'Y']
+    for n, p in zip(names, periods):
+        # Periods are stored as integer ordinals, labels are formatted only when plotting
+        df.insert(2, n, df['Activity Date'].dt.to_period(p))
+    # Convert moving time from seconds to hours
+    df.insert(0, 'Moving Time (hr)', df['Moving Time'] / 3600)
+    # Convert distance from meters to kilometers
+    df.insert(0, 'Distance (km)', df['Distance.1'] / 1000)
+    # Calculate average speed
+    df.insert(0, 'Average Speed (km/hr)', df['Distance (km)'] / df['Moving Time (hr)'])
+    return df
+
+
+def listed_activity_files(df):
+    """
+    Get the FIT, GPX and TCX files referenced in activities.csv.
+
+    Parameters:
+    df (pandas.DataFrame): Activities.
+
+    Returns:
+    pandas.Series: 'Filename' values of activity files.
+    """
+    return df['Filename'].loc[df['Filename'].str.endswith(ACTIVITY_SUFFIXES, na=False)]
+
+
+def merge_coords(df, coords):
+    """
+    Enrich coords with activities.csv data into a new DataFrame, cdf.
+
+    Parameters:
+    df (pandas.DataFrame): Activities.
+    coords (pandas.DataFrame): Start coordinates from decode_start_records.
+
+    Returns:
+    pandas.DataFrame: Activities that have coordinates.
+    """
+    return pd.merge(
+        left=df,
+        right=coords,
+        how='inner',
+        on=['Filename'],
+    )
+
+
+def load_export_csv(zip_path=None, csv=None, trace=None):
+    """
+    Run the activities.csv part of the pipeline, everything the distance and time charts need.
+
+    Parameters:
+    zip_path (str or file-like): Strava export archive, only read when csv is not given.
+    csv (str or file-like): activities.csv.
+    trace (Trace): Optional trace collecting the time and memory of each stage.
+
+    Returns:
+    tuple: Activities DataFrame and period rollups.
+    """
+    if trace is None:
+        trace = Trace()
+    with trace.stage('csv_load') as stage:
+        df = read_export_activities(zip_path, csv)
+        stage['rows'] = len(df)
+    with trace.stage('period_derivation') as stage:
+        df = add_derived_columns(df)
+        stage['rows'] = len(df)
+    with trace.stage('aggregation') as stage:
+        # Precompute period rollups for every time unit once per dataset
+        rollups = build_rollups(df)
+        stage['rows'] = sum(len(rollup) for rollup in rollups.values())
+    return df, rollups
+
+
+def decode_export_fit(zip_path, df, cache=None, max_workers=FIT_WORKERS, chunksize=FIT_CHUNKSIZE, trace=None, progress=None):
+    """
+    Run the FIT part of the pipeline, the start coordinates the map needs.
+
+    Parameters:
+    zip_path (str or file-like): ZIP archive with the activities/ folder of FIT files.
+    df (pandas.DataFrame): Activities from load_export_csv.
+    cache (FitCache): Optional persistent cache of decoded FIT files.
+    max_workers (int): Number of FIT decode worker processes.
+    chunksize (int): Number of FIT files sent to a worker at once.
+    trace (Trace): Optional trace collecting the time and memory of each stage.
+    progress (callable): Optional callback taking the number of files done and the number of listed files.
+
+    Returns:
+    tuple: Start coordinates, activities with coordinates and FIT decode stats.
+    """
+    if trace is None:
+        trace = Trace()
+    with trace.stage('fit_decode') as stage:
+        # Decode the first pair of coordinates (if it exist) of each referenced FIT file in parallel
+        coords, stats = decode_start_records(zip_path, listed_activity_files(df), max_workers=max_workers, chunksize=chunksize,
+                                             cache=cache, progress=progress)
+        stage['files'] = stats['files']
+        stage['rows'] = len(coords)
+    with trace.stage('merge') as stage:
+        cdf = merge_coords(df, coords)
+        stage['rows'] = len(cdf)
+    return coords, cdf, stats
+
+
+def process_export(zip_path, csv=None, cache=None, max_workers=FIT_WORKERS, chunksize=FIT_CHUNKSIZE, trace=None):
+    """
+    Run the whole ingest pipeline for one Strava export.
+
+    Parameters:
+    zip_path (str or file-like): ZIP archive with the activities/ folder of FIT files.
+    csv (str or file-like): activities.csv, read from inside the archive when not given.
+    cache (FitCache): Optional persistent cache of decoded FIT files.
+    max_workers (int): Number of FIT decode worker processes.
+    chunksize (int): Number of FIT files sent to a worker at once.
+    trace (Trace): Optional trace collecting the time and memory of each stage.
+
+    Returns:
+    dict: Activities DataFrame, period rollups, start coordinates, activities with coordinates and FIT decode stats.
+    """
+    if trace is None:
+        trace = Trace()
+    df, rollups = load_export_csv(zip_path, csv, trace)
+    coords, cdf, stats = decode_export_fit(zip_path, df, cache, max_workers, chunksize, trace)
+    return {'df': df, 'rollups': rollups, 'coords': coords, 'cdf': cdf, 'stats': stats}
+
+
+def save_results(results, path):
+    """
+    Save processed activities to a single Parquet file.
+
+    Activities without coordinates are kept with empty coordinate columns.
+
+    Parameters:
+    results (dict): Output of process_export.
+    path (str): Destination .parquet file.
+    """
+    pd.merge(results['df'], results['coords'], how='left', on=['Filename']).to_parquet(path, index=False)
+
+
+def split_results(merged, rollups=None):
+    """
+    Split activities merged with their start coordinates into the parts returned by process_export.
+
+    Parameters:
+    merged (pandas.DataFrame): Activities with coordinate columns, empty for activities without a position.
+    rollups (dict): Period rollups, built from the activities when not given.
+
+    Returns:
+    dict: Activities DataFrame, period rollups, start coordinates and activities with coordinates.
+    """
+    df = merged.drop(columns=COORD_COLUMNS)
+    located = merged['lat'].notna()
+    coords = merged.loc[located, ['Filename', *COORD_COLUMNS]].reset_index(drop=True)
+    cdf = merged.loc[located].reset_index(drop=True)
+    return {'df': df, 'rollups': build_rollups(df) if rollups is None else rollups, 'coords': coords, 'cdf': cdf, 'stats': None}
+
+
+def load_results(path):
+    """
+    Load a Parquet file written by save_results without processing the export again.
+
+    Parameters:
+    path (str or file-like): Parquet file.
+
+    Returns:
+    dict: Activities DataFrame, period rollups, start coordinates and activities with coordinates.
+    """
+    return split_results(pd.read_parquet(path))
+
+
+def ingest_export(store, zip_path, csv=None, cache=None, max_workers=FIT_WORKERS, chunksize=FIT_CHUNKSIZE, trace=None, progress=None):
+    """
+    Merge an export into the athlete store, decoding only the FIT files of new or changed activities.
+
+    Activities are matched by 'Activity ID' and a hash of their activities.csv row. Stored
+    activities missing from the export were deleted on Strava and are dropped. The period totals
+    and the training load are updated with the differences only, the rollups are then rebuilt from the totals.
+
+    Parameters:
+    store (AthleteStore): Store of the athlete.
+    zip_path (str or file-like): ZIP archive with the activities/ folder of FIT files.
+    csv (str or file-like): activities.csv, read from inside the archive when not given.
+    cache (FitCache): Optional persistent cache of decoded FIT files.
+    max_workers (int): Number of FIT decode worker processes.
+    chunksize (int): Number of FIT files sent to a worker at once.
+    trace (Trace): Optional trace collecting the time and memory of each stage.
+    progress (callable): Optional callback taking the number of FIT files done and the number to decode.
+
+    Returns:
+    dict: Same parts as process_export and the training load series, the stats also count new,
+    changed and removed activities.
+    """
+    if trace is None:
+        trace = Trace()
+    with trace.stage('csv_load') as stage:
+        df = read_export_activities(zip_path, csv)
+        stage['rows'] = len(df)
+    with trace.stage('store_load') as stage:
+        stored, totals, load = store.load()
+        stage['rows'] = 0 if stored is None else len(stored)
+    with trace.stage('diff') as stage:
+        hashes = row_hashes(df, USECOLS)
+        if stored is None:
+            fresh, stale = np.ones(len(df), dtype=bool), None
+            counts = {'new': len(df), 'changed': 0, 'removed': 0}
+        else:
+            fresh, stale = diff_activities(stored, df['Activity ID'], hashes)
+            # Activities both stale and fresh are the ones changed since the last upload
+            changed = int(stored.loc[stale, 'Activity ID'].isin(df.loc[fresh, 'Activity ID']).sum())
+            counts = {'new': int(fresh.sum()) - changed, 'changed': changed, 'removed': int(stale.sum()) - changed}
+        stage.update(counts)
+    with trace.stage('period_derivation') as stage:
+        added = add_derived_columns(df.loc[fresh].reset_index(drop=True))
+        added[ROW_HASH] = hashes[fresh]
+        stage['rows'] = len(added)
+    with trace.stage('aggregation') as stage:
+        if stale is None:
+            totals = build_totals(added)
+        else:
+            removed = stored.loc[stale]
+            totals = {time_unit: update_totals(totals[time_unit], time_unit, added=added, removed=removed) for time_unit in TIME_UNITS}
+        rollups = rollups_from_totals(totals)
+        stage['rows'] = sum(len(rollup) for rollup in rollups.values())
+    with trace.stage('training_load') as stage:
+        if stale is None or load is None:
+            # Stores saved before the training load was kept get it on their next upload
+            load = build_training_load(added if stale is None else pd.concat([stored.loc[~stale], added]))
+        else:
+            load = update_training_load(load, added=added, removed=stored.loc[stale])
+        stage['rows'] = len(load)
+    with trace.stage('fit_decode') as stage:
+        coords, stats = decode_start_records(zip_path, listed_activity_files(added), max_workers=max_workers, chunksize=chunksize,
+                                             cache=cache, progress=progress)
+        stage['files'] = stats['files']
+        stage['rows'] = len(coords)
+    with trace.stage('merge') as stage:
+        merged = pd.merge(added, coords, how='left', on=['Filename'])
+        kept = [] if stale is None else [stored.loc[~stale]]
+        activities = pd.concat([*kept, merged], ignore_index=True)
+        activities = activities.sort_values('Activity Date', kind='stable', ignore_index=True)
+        # Categories of the stored and the new activities differ, concat falls back to strings
+        activities['Activity Type'] = activities['Activity Type'].astype('category')
+        stage['rows'] = len(activities)
+    with trace.stage('store_save'):
+        store.save(activities, totals, load)
+    results = split_results(activities.drop(columns=ROW_HASH), rollups)
+    results['stats'] = {**stats, **counts}
+    results['load'] = load
+    return results
@@ -1,13 +1,640 @@
 import streamlit as st
-import pandas as pd
-import plotly.express as px
-import plotly.graph_objects as go
-import os, gzip
-import zipfile
-import glob
-import fitdecode
-from pathlib import Path
-import shutil
+import io
+import re
+from athlete_store import AthleteStore, row_hashes
+from fit_cache import FitCache, TrackCache, content_hash
+from background import BackgroundJob
+from instrument import Trace
+
+# Plotly and the pipeline modules (pandas, fitdecode) are imported inside the functions using them,
+# so opening the page and uploading files does not wait for them
+
+# st.cache_data replaced st.experimental_memo in newer Streamlit releases
+cache_data = getattr(st, 'cache_data', None) or st.experimental_memo
+
+# Processed exports are kept for an hour, only the most recent ones
+PIPELINE_TTL = 3600
+PIPELINE_MAX_ENTRIES = 8
+# Seconds between progress bar updates while the fit files are decoded
+PROGRESS_INTERVAL = 0.25
+# Downsampled series of the activity detail view kept in memory, one entry per activity viewed
+SERIES_MAX_ENTRIES = 256
+
+
+def upload_key(uploaded_files):
+    """
+    Hash the contents of the uploaded files so identical uploads share one processed result.
+
+    Parameters:
+    uploaded_files (list): Files returned by st.file_uploader.
+
+    Returns:
+    str: Combined content hash of all files.
+    """
+    return content_hash(b''.join(content_hash(f.getbuffer()).encode() for f in sorted(uploaded_files, key=lambda f: f.name)))
+
+
+def private_copy(uploaded_file):
+    """
+    Open an uploaded file again for a BackgroundJob, nothing is written to disk.
+
+    The page keeps seeking the uploaded file on every rerun, the copy has its own position and
+    shares the bytes of the upload instead of copying them.
+
+    Parameters:
+    uploaded_file (file-like): File returned by st.file_uploader.
+
+    Returns:
+    io.BytesIO: File with the same contents.
+    """
+    return io.BytesIO(uploaded_file.getvalue())
+
+
+@cache_data(ttl=PIPELINE_TTL, max_entries=PIPELINE_MAX_ENTRIES, show_spinner=False)
+def load_csv(key, _csv_file, _trace=None):
+    """
+    Run the activities.csv part of the pipeline for one upload, memoized on the upload hash.
+
+    Parameters:
+    key (str): Hash of the uploaded activities.csv, the only argument the memoization looks at.
+    _csv_file (file-like): Uploaded activities.csv.
+    _trace (Trace): Optional trace of the pipeline stages, only filled when the result is not memoized yet.
+
+    Returns:
+    tuple: Activities DataFrame and period rollups.
+    """
+    import pipeline
+    _csv_file.seek(0)
+    return pipeline.load_export_csv(csv=_csv_file, trace=_trace)
+
+
+def decode_upload(zip_file, df, progress=None, trace=None):
+    """
+    Decode the start coordinates of the uploaded FIT files, run in a BackgroundJob.
+
+    The members are read from the upload in memory, nothing is written to disk.
+
+    Parameters:
+    zip_file (file-like): Uploaded ZIP archive.
+    df (pandas.DataFrame): Activities from load_csv.
+    progress (callable): Callback taking the number of files done and the total.
+    trace (Trace): Trace of the pipeline stages.
+
+    Returns:
+    dict: Start coordinates, activities with coordinates and FIT decode stats.
+    """
+    import pipeline
+    # SQLite connections belong to the thread that opened them
+    with FitCache() as cache:
+        coords, cdf, stats = pipeline.decode_export_fit(private_copy(zip_file), df, cache=cache, trace=trace, progress=progress)
+    return {'coords': coords, 'cdf': cdf, 'stats': stats}
+
+
+def ingest_upload(store, uploaded_files, progress=None, trace=None):
+    """
+    Merge an upload into the athlete store, only new and changed activities are processed.
+
+    Not memoized, the result depends on what is already stored. Run in a BackgroundJob.
+
+    Parameters:
+    store (AthleteStore): Store of the athlete.
+    uploaded_files (list): Files returned by st.file_uploader.
+    progress (callable): Callback taking the number of files done and the total.
+    trace (Trace): Trace of the pipeline stages.
+
+    Returns:
+    dict: Output of pipeline.ingest_export.
+    """
+    import pipeline
+    zip_file = next(f for f in uploaded_files if f.name.endswith('.zip'))
+    csv_file = next(f for f in uploaded_files if not f.name.endswith('.zip'))
+    with FitCache() as cache:
+        return pipeline.ingest_export(store, private_copy(zip_file), csv=private_copy(csv_file), cache=cache, trace=trace, progress=progress)
+
+
+def export_store(df):
+    """
+    Open the athlete store of an uploaded export.
+
+    Parameters:
+    df (pandas.DataFrame): Activities from load_csv.
+
+    Returns:
+    AthleteStore: Store found from the activities.csv rows of the export.
+    """
+    from pipeline import USECOLS
+    return AthleteStore.for_export(df, row_hashes(df, USECOLS))
+
+
+def finish_job(job, trace):
+    """
+    Merge the result of a finished FIT job into the session results and report it.
+
+    Parameters:
+    job (BackgroundJob): Finished job of decode_upload or ingest_upload.
+    trace (Trace): Trace of this script run, gets the stages of the job.
+    """
+    trace.stages.extend(job.trace.stages)
+    del st.session_state['fit_job']
+    if job.error is not None:
+        st.session_state['fit_error'] = f'Processing your fit files failed: {job.error}'
+        return
+    st.session_state['strava'].update(job.result)
+    stats = job.result['stats']
+    message = (f"Processed {stats['files']} activity files in {stats['seconds']:.1f} s ({stats['files_per_second']:.0f} files/s), "
+               f"{stats['cache_hits']} served from cache and {stats['decoded']} decoded")
+    if 'new' in stats:
+        message = f"{stats['new']} new, {stats['changed']} changed and {stats['removed']} removed activities since the last upload. " + message
+    st.session_state['fit_message'] = message
+
+
+def distance_figure(rollup, time_unit):
+    """
+    Plot the cumulative distance covered in each activity type.
+
+    Parameters:
+    rollup (pandas.DataFrame): Rollup of the selected time unit.
+    time_unit (str): One of TIME_UNITS.
+
+    Returns:
+    plotly.graph_objects.Figure: Stacked area plot.
+    """
+    import plotly.express as px
+    from aggregation import cumulative_distance, with_labels
+    # Exclude activities with <= 1 km total covered you can increase or decrease this cutoff based on your data
+    csum = with_labels(cumulative_distance(rollup, min_total_km=1), time_unit)
+    # For the plot tile
+    total_km = round(rollup['total_distance_km'].sum())
+    # Plot a stacked area plot
+    fig_km = px.area(
+        csum,
+        x=time_unit,
+        y='csum_km',
+        color='Activity Type',
+        title=f'My {total_km} Kilometers on Strava!',  # Set title text
+        hover_data={  # Define variables for hover text
+            'csum_km': ':.1f',
+            'count': ':f',
+            'total_distance_km': ':.1f',
+            'avg_distance_km': ':.1f',
+        },
+        labels=dict(  # Define labels for variables
+            count='Number of activities',
+            avg_distance_km='Average kms per activity',
+            total_distance_km='Total kms covered',
+            csum_km='Cumulative kms covered',
+        ),
+        color_discrete_sequence=px.colors.qualitative.Bold,  # Define color swatch
+    )
+    # Set max allowed of ticks on x and y axes
+    fig_km.update_xaxes(nticks=20)
+    fig_km.update_yaxes(nticks=15)
+    # Adjust the size and layout
+    fig_km.update_layout(
+        autosize=False,
+        width=700,
+        height=500,
+        template='plotly_white',  # Others options: 'plotly', 'plotly_dark', 'ggplot2', 'seaborn', 'simple_white'
+        title={'y': 0.9, 'x': 0.5, 'xanchor': 'center', 'yanchor': 'top'},  # Center title
+    )
+    return fig_km
+
+
+def time_figure(rollup, time_unit):
+    """
+    Plot the time spent in each activity type.
+
+    Parameters:
+    rollup (pandas.DataFrame): Rollup of the selected time unit.
+    time_unit (str): One of TIME_UNITS.
+
+    Returns:
+    plotly.graph_objects.Figure: Stacked bar plot.
+    """
+    import plotly.express as px
+    from aggregation import time_spent, with_labels
+    # For the plot tile
+    total_hr = round(rollup['total_hr_spent'].sum())
+    # Plot a stacked bar plot
+    fig_hr = px.bar(
+        with_labels(time_spent(rollup), time_unit),
+        x=time_unit,
+        y='total_hr_spent',
+        color='Activity Type',
+        title=f'My {total_hr} hours on Strava!',  # Set title text
+        hover_data={  # Define variables for hover text
+            'count': ':f',
+            'total_hr_spent': ':.1f',
+            'avg_hr_spent': ':.1f',
+        },
+        labels=dict(  # Define labels for variables
+            total_hr_spent='Total hrs spent',
+            count='Number of activities',
+            avg_hr_spent='Average hrs spent per activity',
+        ),
+        color_discrete_sequence=px.colors.qualitative.Bold,  # Define color swatch
+    )
+    # Set max allowed of ticks on x and y axes
+    fig_hr.update_xaxes(nticks=20)
+    fig_hr.update_yaxes(nticks=15)
+    # Adjust the size and layout
+    fig_hr.update_layout(
+        autosize=False,
+        width=700,
+        height=500,
+        template='plotly_white',  # Others options: 'plotly', 'plotly_dark', 'ggplot2', 'seaborn', 'simple_white'
+        legend=dict(  # Move the legend to the bottom
+            orientation='h',
+            yanchor='bottom',
+            y=-0.6,
+            xanchor='right',
+            x=1,
+            title=None,  # Remove legend title
+        ),
+        title={'y': 0.9, 'x': 0.5, 'xanchor': 'center', 'yanchor': 'top'},  # Center title
+    )
+    return fig_hr
+
+
+def map_figure(cdf, max_markers=None):
+    """
+    Plot the start locations of activities on a map.
+
+    Nearby activities of the same type share one marker sized by their total distance,
+    so the figure holds at most max_markers markers however long the history is.
+
+    Parameters:
+    cdf (pandas.DataFrame): Activities with coordinates.
+    max_markers (int): Upper bound of markers, geo.MAX_MARKERS by default.
+
+    Returns:
+    plotly.graph_objects.Figure: Scatter plot map.
+    """
+    import plotly.express as px
+    from geo import MAX_MARKERS, bin_activities
+    markers, cell_size = bin_activities(cdf, max_markers or MAX_MARKERS)
+    # Plot a scatter plot map
+    fig_map = px.scatter_geo(
+        markers,
+        lat='lat',
+        lon='long',
+        size='total_distance_km',
+        color='Activity Type',
+        projection='natural earth',
+        title='Mapping my workouts!',  # Set title
+        opacity=0.75,  # Adjust opacity of dots
+        color_discrete_sequence=px.colors.qualitative.Bold,  # Define color swatch
+        custom_data=[  # Variables for the hover text
+            'label',
+            'count',
+            'first_date',
+            'last_date',
+            'total_distance_km',
+            'avg_speed',
+            'total_elevation_gain',
+        ],
+    )
+    # Center your map based on your coordinates
+    fig_map.update_geos(fitbounds='locations')
+    # Customize hover text
+    fig_map.update_traces(
+        hovertemplate='%{customdata[0]}<br>'
+        'Activities: %{customdata[1]}<br>'
+        'Dates: %{customdata[2]|%Y-%m-%d} to %{customdata[3]|%Y-%m-%d}<br>'
+        'Total distance (km): %{customdata[4]:.1f}<br>'
+        'Average Speed (km/hr): %{customdata[5]:.1f}<br>'
+        'Total elevation gain: %{customdata[6]:.1f}'
+        f'<extra>Within {cell_size * 111:.1f} km</extra>'
+    )
+    # Adjust the size and layout
+    fig_map.update_layout(
+        autosize=False,
+        width=750,
+        height=500,
+        legend=dict(  # Move the legend to the bottom
+            orientation='h',
+            yanchor='bottom',
+            y=-0.1,
+            xanchor='right',
+            x=1,
+            title=None,  # Remove legend title
+        ),
+        title={'y': 0.85, 'x': 0.5, 'xanchor': 'center', 'yanchor': 'top'},  # Center title
+    )
+    # Customize the colors of the map
+    fig_map.update_geos(
+        resolution=50,
+        showcountries=True, countrycolor='forestgreen',
+        showcoastlines=True, coastlinecolor='darkolivegreen',
+        showland=True, landcolor='darkseagreen',
+        showocean=True, oceancolor='lightcyan',
+        showlakes=True, lakecolor='LightBlue',
+        showrivers=True, rivercolor='LightBlue',
+    )
+    return fig_map
+
+
+def track_summaries(zip_file, filenames, trace):
+    """
+    Read every record of the listed activity files and reduce them to per activity summaries.
+
+    Parameters:
+    zip_file (file-like): Uploaded ZIP archive.
+    filenames (pandas.Series): 'Filename' values of the activity files.
+    trace (Trace): Trace of the pipeline stages.
+
+    Returns:
+    dict: Filenames, the summary matrices of tracks.SUMMARIES and the decode stats.
+    """
+    from tracks import decode_track_summaries
+    with trace.stage('track_decode') as stage:
+        with TrackCache() as cache:
+            names, matrices, stats = decode_track_summaries(zip_file, filenames, cache=cache)
+        stage['files'] = stats['files']
+        stage['decoded'] = stats['decoded']
+    return {'filenames': names, **matrices, 'stats': stats}
+
+
+def zones_figure(period_zones, time_unit, title):
+    """
+    Plot the hours spent in each zone per time period.
+
+    Parameters:
+    period_zones (pandas.DataFrame): Output of zones.zones_per_period.
+    time_unit (str): One of TIME_UNITS.
+    title (str): Title of the plot.
+
+    Returns:
+    plotly.graph_objects.Figure: Stacked bar plot.
+    """
+    import plotly.express as px
+    from aggregation import with_labels
+    fig_zones = px.bar(
+        with_labels(period_zones, time_unit),
+        x=time_unit,
+        y='Hours',
+        color='Zone',
+        title=title,
+        hover_data={'Hours': ':.1f'},
+        color_discrete_sequence=px.colors.sequential.YlOrRd[2:],  # From easy to hard
+    )
+    fig_zones.update_xaxes(nticks=20)
+    fig_zones.update_layout(
+        autosize=False,
+        width=700,
+        height=500,
+        template='plotly_white',
+        title={'y': 0.9, 'x': 0.5, 'xanchor': 'center', 'yanchor': 'top'},  # Center title
+    )
+    return fig_zones
+
+
+def tracks_section(df, uploaded_files, time_unit, trace):
+    """
+    Show the time in zones and best efforts computed from every record of the fit files.
+
+    Parameters:
+    df (pandas.DataFrame): Activities.
+    uploaded_files (list): Files returned by st.file_uploader.
+    time_unit (str): One of TIME_UNITS.
+    trace (Trace): Trace of this script run.
+    """
+    from aggregation import TIME_UNITS
+    st.subheader('Analyze every record of your activities')
+    zip_files = [f for f in uploaded_files if f.name.endswith('.zip')]
+    # Hashed once by Execute Code, hashing a large archive on every rerun would take seconds.
+    # Results loaded from a .parquet file have no archive
+    key = st.session_state['strava'].get('zip_key')
+    if not zip_files or key is None:
+        st.info('Upload the ZIP file with your fit files to see your time in zones and best efforts.')
+        return
+    import pipeline
+    if st.session_state.get('tracks', {}).get('key') != key and st.button('Analyze tracks'):
+        with st.spinner('Reading every record of your fit files...'):
+            st.session_state['tracks'] = {'key': key, **track_summaries(zip_files[0], pipeline.listed_activity_files(df), trace)}
+    if st.session_state.get('tracks', {}).get('key') != key:
+        return
+    summaries = st.session_state['tracks']
+    categories = list(df['Activity Type'].cat.categories)
+    activity_types = st.multiselect('Activity types', categories, default=['Run'] if 'Run' in categories else None)
+
+
+    st.subheader('Vizualize your time in heart rate and pace zones')
+    import zones
+    from calculator import parse_pace
+    # Default to a high percentile, a single sensor spike should not move the zones
+    default_hr = int(df['Max Heart Rate'].quantile(0.99)) if df['Max Heart Rate'].notna().any() else 190
+    # Many spikes or mostly missing straps can still put it outside the input bounds
+    max_hr = st.number_input('Maximum heart rate (bpm)', min_value=100, max_value=250, value=min(max(default_hr, 100), 250))
+    threshold_pace = st.text_input('Threshold pace (mm\\:ss per km)', value='4:30')
+    # Zones are summed from the histograms, changing the bounds does not read the files again
+    hr_zones = zones.zones_per_activity(df, summaries['filenames'], zones.hr_zone_seconds(summaries['hr_seconds'], max_hr))
+    if activity_types:
+        hr_zones = hr_zones.loc[hr_zones['Activity Type'].isin(activity_types)]
+    with trace.stage('zones_figure') as stage:
+        st.plotly_chart(zones_figure(zones.zones_per_period(hr_zones, zones.HR_ZONES, time_unit), time_unit, 'Time in heart rate zones'))
+        # 0:00 matches the format but is no pace
+        if re.fullmatch(r'\d{1,2}:\d{2}', threshold_pace) and parse_pace(threshold_pace) > 0:
+            pace_zones = zones.zones_per_activity(
+                df, summaries['filenames'], zones.pace_zone_seconds(summaries['speed_seconds'], parse_pace(threshold_pace)))
+            if activity_types:
+                pace_zones = pace_zones.loc[pace_zones['Activity Type'].isin(activity_types)]
+            st.plotly_chart(zones_figure(zones.zones_per_period(pace_zones, zones.PACE_ZONES, time_unit), time_unit, 'Time in pace zones'))
+        else:
+            st.warning('Incorrect pace format. Please use the format mm:ss')
+        stage['rows'] = len(hr_zones)
+    st.write('Minutes in heart rate zones per activity')
+    st.dataframe(hr_zones.drop(columns=['Filename', *TIME_UNITS]).sort_values('Activity Date', ascending=False))
+
+
+    st.subheader('Your best efforts')
+    from calculator import format_paces, format_times
+    from efforts import EFFORT_DISTANCES, efforts_per_activity, personal_records
+    activity_efforts = efforts_per_activity(df, summaries['filenames'], summaries['best_efforts'])
+    if activity_types:
+        activity_efforts = activity_efforts.loc[activity_efforts['Activity Type'].isin(activity_types)]
+    records = personal_records(activity_efforts)
+    st.write('Personal records')
+    st.dataframe(records.assign(
+        Time=format_times(records['Seconds'] / 60),
+        **{'Pace (min/km)': format_paces(records['Pace (min/km)'])},
+    )[['Distance', 'Time', 'Pace (min/km)', 'Activity Name', 'Activity Date']])
+    st.write('Best efforts per activity')
+    table = activity_efforts.drop(columns='Filename').sort_values('Activity Date', ascending=False)
+    for name in EFFORT_DISTANCES:
+        # Activities shorter than the distance have no effort
+        table[name] = table[name].where(table[name].isna(), format_times(table[name].fillna(0) / 60))
+    st.dataframe(table)
+
+
+@cache_data(max_entries=SERIES_MAX_ENTRIES, show_spinner=False)
+def activity_series(h, _filename, _data, points):
+    """
+    Read the track of one activity and downsample it for the activity detail view.
+
+    The track comes from the track cache when the activity was analyzed before, otherwise it is
+    decoded and stored there with its summaries. Memoized on the content hash of the fit file.
+
+    Parameters:
+    h (str): Content hash of the raw gzip bytes.
+    _filename (str): 'Filename' of the activity.
+    _data (bytes): Raw gzip bytes of the fit file.
+    points (int): Points kept per series.
+
+    Returns:
+    dict: Output of downsample.track_series, None when the file could not be read.
+    """
+    from downsample import track_series
+    from tracks import decode_track_chunk, unpack_track
+    with TrackCache() as cache:
+        packed = cache.get_track(h)
+        if packed is None:
+            _, *values = decode_track_chunk([(_filename, _data)], keep_tracks=True)[0]
+            cache.put_many([(h, *values)])
+            packed = values[-1]
+    return None if packed is None else track_series(unpack_track(packed), points)
+
+
+def activity_figure(series, title):
+    """
+    Plot the pace, heart rate and elevation of one activity over time.
+
+    Parameters:
+    series (dict): Output of activity_series.
+    title (str): Title of the plot.
+
+    Returns:
+    plotly.graph_objects.Figure: Line plots sharing the time axis, drawn with WebGL.
+    """
+    import plotly.graph_objects as go
+    from plotly.subplots import make_subplots
+    from downsample import SERIES
+    fig_activity = make_subplots(rows=len(SERIES), cols=1, shared_xaxes=True, vertical_spacing=0.04)
+    for row, (name, (_, label)) in enumerate(SERIES.items(), start=1):
+        minutes, values = series[name]
+        # Scattergl draws on a canvas instead of one SVG node per point
+        fig_activity.add_trace(go.Scattergl(x=minutes, y=values, mode='lines', name=label,
+                                            hovertemplate='%{y:.1f} at %{x:.1f} min<extra></extra>'), row=row, col=1)
+        fig_activity.update_yaxes(title_text=label, row=row, col=1)
+    # A faster pace is a lower number, keep it at the top
+    fig_activity.update_yaxes(autorange='reversed', row=list(SERIES).index('pace') + 1, col=1)
+    fig_activity.update_xaxes(title_text='Minutes', row=len(SERIES), col=1)
+    fig_activity.update_layout(
+        autosize=False,
+        width=700,
+        height=700,
+        template='plotly_white',
+        showlegend=False,
+        title={'text': title, 'y': 0.95, 'x': 0.5, 'xanchor': 'center', 'yanchor': 'top'},  # Center title
+    )
+    return fig_activity
+
+
+def activity_section(df, uploaded_files, trace):
+    """
+    Show the pace, heart rate and elevation of one chosen activity.
+
+    Parameters:
+    df (pandas.DataFrame): Activities.
+    uploaded_files (list): Files returned by st.file_uploader.
+    trace (Trace): Trace of this script run.
+    """
+    st.subheader('Look into a single activity')
+    zip_files = [f for f in uploaded_files if f.name.endswith('.zip')]
+    if not zip_files:
+        st.info('Upload the ZIP file with your fit files to look into your activities.')
+        return
+    import pipeline
+    from activity_files import iter_activity_members
+    from downsample import POINT_BUDGET
+    activities = df.loc[df['Filename'].isin(pipeline.listed_activity_files(df))].sort_values('Activity Date', ascending=False)
+    if activities.empty:
+        return
+    labels = dict(zip(activities['Filename'], activities['Activity Name'] + activities['Activity Date'].dt.strftime(' (%Y-%m-%d)')))
+    filename = st.selectbox('Activity', list(labels), format_func=labels.get)
+    with trace.stage('activity_figure') as stage:
+        members = dict(iter_activity_members(zip_files[0], [filename]))
+        if filename not in members:
+            st.warning(f'{filename} is not in the ZIP file.')
+            return
+        data = members[filename]
+        series = activity_series(content_hash(data), filename, data, POINT_BUDGET)
+        if series is None:
+            st.warning(f'{filename} could not be read.')
+            return
+        st.plotly_chart(activity_figure(series, labels[filename]))
+        stage['rows'] = sum(len(minutes) for minutes, _ in series.values())
+
+
+def spatial_index(cdf, trace):
+    """
+    Get the spatial index of the activities with coordinates, built once per dataset.
+
+    Parameters:
+    cdf (pandas.DataFrame): Activities with coordinates.
+    trace (Trace): Trace of this script run.
+
+    Returns:
+    geo.SpatialIndex: Index kept in the session until the activities change.
+    """
+    from geo import SpatialIndex
+    # The DataFrame is replaced, not modified, when new results come in
+    if st.session_state.get('places', {}).get('cdf') is not cdf:
+        with trace.stage('spatial_index') as stage:
+            st.session_state['places'] = {'cdf': cdf, 'index': SpatialIndex(cdf)}
+            stage['rows'] = len(cdf)
+    return st.session_state['places']['index']
+
+
+def places_section(cdf, trace):
+    """
+    Query the places of activities: around a point, most visited and new ones, with their activities.
+
+    Parameters:
+    cdf (pandas.DataFrame): Activities with coordinates.
+    trace (Trace): Trace of this script run.
+    """
+    from geo import PLACE_KM
+    st.subheader('Find interesting locations of your training sessions')
+    index = spatial_index(cdf, trace)
+    query = st.radio('Show', ['Most visited places', 'New places', 'Activities around a point'], horizontal=True)
+    place_columns = {'name': 'Latest activity', 'visits': 'Visits', 'first_visit': 'First visit',
+                     'last_visit': 'Last visit', 'total_distance_km': 'Total distance (km)'}
+    with trace.stage('places_query') as stage:
+        if query == 'Most visited places':
+            count = st.slider('Number of places', min_value=5, max_value=50, value=10)
+            places = index.most_visited(count)
+        elif query == 'New places':
+            months = cdf['Month'].drop_duplicates().sort_values(ascending=False)
+            # The latest month of the export, the current month is usually not in it yet
+            month = st.selectbox('Month', list(months), format_func=str)
+            places = index.new_places(month.start_time, (month + 1).start_time)
+        else:
+            top = index.most_visited(1)
+            col1, col2, col3 = st.columns(3)
+            lat = col1.number_input('Latitude', min_value=-90.0, max_value=90.0, value=float(top['lat'].iloc[0]), format='%.5f')
+            long = col2.number_input('Longitude', min_value=-180.0, max_value=180.0, value=float(top['long'].iloc[0]), format='%.5f')
+            radius = col3.number_input('Radius (km)', min_value=0.1, max_value=20000.0, value=5.0)
+            places = None
+            activities = index.within(lat, long, radius)
+        if places is not None:
+            stage['rows'] = len(places)
+            st.write(f'{len(places)} places of about {PLACE_KM:g} km')
+            if places.empty:
+                return
+            st.dataframe(places[list(place_columns)].rename(columns=place_columns).reset_index(drop=True))
+            # Drill down into the activities of one place
+            place = st.selectbox('Place', list(places.index),
+                                 format_func=lambda p: f'{places.at[p, "name"]} ({places.at[p, "visits"]} visits)')
+            activities = index.place_activities(place)
+        else:
+            stage['rows'] = len(activities)
+    st.write(f'{len(activities)} activities')
+    if activities.empty:
+        return
+    st.plotly_chart(map_figure(activities))
+    columns = ['Activity Name', 'Activity Date', 'Activity Type', 'Distance (km)', 'Average Speed (km/hr)', 'Elevation Gain']
+    st.dataframe(activities[[c for c in ['Distance from point (km)', *columns] if c in activities]].reset_index(drop=True))
 
 
 def app():
@@ -22,274 +649,149 @@ def app():
         * CSV file of your activities 
         * ZIP folder with your fit files
 
+    Or upload a single .parquet file produced by the batch processing (batch.py).
+
+    Keep your activities between uploads and only the new and changed activities of a newer export
+    are processed. The stored activities are found from the uploaded export itself, they can only be
+    seen or deleted together with it.
     ''')
-    uploaded_files = st.file_uploader('Choose a file', type=['zip', 'csv'], accept_multiple_files=True)
+    uploaded_files = st.file_uploader('Choose a file', type=['zip', 'csv', 'parquet'], accept_multiple_files=True)
+    keep = st.checkbox('Keep my activities between uploads, so only new and changed ones are processed next time')
+    # Stages of this script run, shown in the debug panel of the sidebar. tracemalloc also counts the
+    # allocations of a running fit job, so memory is only traced when there is none
+    job = st.session_state.get('fit_job')
+    trace = Trace(track_memory=st.session_state.get('debug', False) and (job is None or job.done()))
+    st.session_state['trace'] = trace
     # Button to execute code after files are uploaded
     if st.button('Execute Code'):
-        if len(uploaded_files) == 2:
-            os.mkdir('uploads')
-            # Save ZIP archive and CSV file to the local directory
-            def save_uploadedfile(uploaded_file):
-                with open(os.path.join('uploads', uploaded_file.name),'wb') as f:
-                    f.write(uploaded_file.getbuffer())
-            
+        st.session_state.pop('fit_job', None)
+        st.session_state.pop('fit_message', None)
+        st.session_state.pop('fit_error', None)
+        if len(uploaded_files) == 1 and uploaded_files[0].name.endswith('.parquet'):
+            import pipeline
+            # Already processed, nothing to decode
+            with trace.stage('parquet_load') as stage:
+                st.session_state['strava'] = pipeline.load_results(uploaded_files[0])
+                stage['rows'] = len(st.session_state['strava']['df'])
+            st.success(f'{uploaded_files[0].name} loaded successfully!')
+        elif len(uploaded_files) == 2:
+            csv_file = next(f for f in uploaded_files if not f.name.endswith('.zip'))
+            zip_file = next(f for f in uploaded_files if f.name.endswith('.zip'))
+            with st.spinner('Reading your activities...'):
+                with trace.stage('upload_hash') as stage:
+                    key = upload_key([csv_file])
+                    zip_key = upload_key([zip_file])
+                    stage['files'] = len(uploaded_files)
+                # The charts only need activities.csv, memoized results leave no stages in the trace
+                df, rollups = load_csv(key, csv_file, trace)
             for uploaded_file in uploaded_files:
-                file_details = {'Filename':uploaded_file.name,'FileType':uploaded_file.type,'FileSize':uploaded_file.size}
-                save_uploadedfile(uploaded_file)
                 st.success(f'{uploaded_file.name} uploaded successfully!')
-                
-
-            st.subheader('This is the head of your data')
-            usecols = ['Activity ID', 'Activity Date', 'Activity Name', 'Activity Type', 'Max Heart Rate', 'Relative Effort',
-                        'Filename', 'Moving Time', 'Distance.1', 'Elevation Gain', 'Average Heart Rate']
-            df = pd.read_csv(
-                            'uploads/activities.csv',
-                            usecols=usecols,
-                            parse_dates=['Activity Date'],
-                            header=0
-                            )
-            # Add day, week, month, quarter, year columns
-            names = ['Day', 'Week', 'Month', 'Quarter', 'Year']
-            periods = ['D', 'W', 'M', 'Q', 'y']
-            for n, p in zip(names, periods):
-                df.insert(2, n, df['Activity Date'].dt.to_period(p).astype(str))
-            # Convert moving time from seconds to hours
-            df.insert(0, 'Moving Time (hr)', df['Moving Time'] / 3600)
-            # Convert distance from meters to kilometers
-            df.insert(0, 'Distance (km)', df['Distance.1'] / 1000)
-            # Calculate average speed
-            df.insert(0, 'Average Speed (km/hr)', df['Distance (km)'] / df['Moving Time (hr)'])
-            st.dataframe(df)
-            # Print date bounds of the data
-            st.write(f'Ranges from {df.Day.min()} to {df.Day.max()}')
-
-            
-            st.subheader('Vizualize your total cumulative distance covered')
-            # Define a time period by which you want to split your overall time: 'Year', 'Quarter', 'Month', 'Week', or 'Day'
-            time_unit_km = 'Month'
-            # Group by time_unit_km and activity type
-            df_km = df.groupby(by=[time_unit_km, 'Activity Type'], as_index=False).agg(
-                count=('Distance (km)', 'count'),
-                total_distance_km=('Distance (km)', 'sum'),
-                avg_distance_km=('Distance (km)', 'mean'),
-            )
-            # This will ensure there is point on the plot for each combination
-            activities = df_km['Activity Type'].unique()
-            activitie_months = df_km[time_unit_km].unique()
-            for a in activities:
-                temp = df_km.loc[df_km['Activity Type'] == a]
-                for t in activitie_months:
-                    if not (temp[time_unit_km] == t).any():
-                        new_row = pd.Series(
-                            [t, a, 0, 0, 0],
-                            index=df_km.columns,
-                        )
-                        df_km = pd.concat([df_km, new_row.to_frame().T], ignore_index=True)
-            # Find and exclude activities with <= 1 km total covered you can increase or decrease this cutoff based on your data
-            kms = df_km.groupby(by=['Activity Type'], as_index=False).sum()
-            kms = kms[kms['total_distance_km'] > 1]
-            # For each activity and time period, calculate the cumulative sum of kms
-            csum = df_km.loc[df_km['Activity Type'].isin(kms['Activity Type'])]
-            x = pd.Series(dtype=float)
-            csum.sort_values(by=['Activity Type', time_unit_km], inplace=True)
-            for a in csum['Activity Type'].unique():
-                temp = csum.loc[csum['Activity Type'] == a].sort_values(by=[time_unit_km])
-                x = pd.concat([x, temp['total_distance_km'].cumsum()])
-            csum['csum_km'] = x
-            
-            # For the plot tile
-            total_km = round(df_km['total_distance_km'].sum())
-            # Plot a stacked area plot
-            fig_km = px.area(
-                csum,
-                x=time_unit_km,
-                y='csum_km',
-                color='Activity Type',
-                title=f'My {total_km} Kilometers on Strava!',  # Set title text
-                hover_data={  # Define variables for hover text
-                    'csum_km': ':.1f',
-                    'count': ':f',
-                    'total_distance_km': ':.1f',
-                    'avg_distance_km': ':.1f',
-                },
-                labels=dict(  # Define labels for variables
-                    count='Number of activities',
-                    avg_distance_km='Average kms per activity',
-                    total_distance_km='Total kms covered',
-                    csum_km='Cumulative kms covered',
-                ),
-                color_discrete_sequence=px.colors.qualitative.Bold,  # Define color swatch
-            )
-            # Set max allowed of ticks on x and y axes
-            fig_km.update_xaxes(nticks=20)
-            fig_km.update_yaxes(nticks=15)
-            # Adjust the size and layout
-            fig_km.update_layout(
-                autosize=False,
-                width=700,
-                height=500,
-                template='plotly_white',  # Others options: 'plotly', 'plotly_dark', 'ggplot2', 'seaborn', 'simple_white'
-                title={'y': 0.9, 'x': 0.5, 'xanchor': 'center', 'yanchor': 'top'},  # Center title
-            )
-            st.plotly_chart(fig_km)
-
-            
-            st.subheader('Vizualize your total time spent in each activity')
-            # Define a time unit: 'Year', 'Quarter', 'Month', 'Week', or 'Day'
-            time_unit_bar = 'Month'
-            # Group by time_unit_bar and activity type
-            df_hr = df.groupby(by=[time_unit_bar, 'Activity Type'], as_index=False).agg(
-                count=('Moving Time (hr)', 'count'),
-                total_hr_spent=('Moving Time (hr)', 'sum'),
-                avg_hr_spent=('Moving Time (hr)', 'mean'),
-            )
-            
-            # For the plot tile
-            total_hr = round(df_hr['total_hr_spent'].sum())
-            # Plot a stacked bar plot
-            fig_hr = px.bar(
-                df_hr,
-                x=time_unit_bar,
-                y='total_hr_spent',
-                color='Activity Type',
-                title=f'My {total_hr} hours on Strava!',  # Set title text
-                hover_data={  # Define variables for hover text
-                    'count': ':f',
-                    'total_hr_spent': ':.1f',
-                    'avg_hr_spent': ':.1f',
-                },
-                labels=dict(  # Define labels for variables
-                    total_hr_spent='Total hrs spent',
-                    count='Number of activities',
-                    avg_hr_spent='Average hrs spent per activity',
-                ),
-                color_discrete_sequence=px.colors.qualitative.Bold,  # Define color swatch
-            )
-            # Set max allowed of ticks on x and y axes
-            fig_hr.update_xaxes(nticks=20)
-            fig_hr.update_yaxes(nticks=15)
-            # Adjust the size and layout
-            fig_hr.update_layout(
-                autosize=False,
-                width=700,
-                height=500,
-                template='plotly_white',  # Others options: 'plotly', 'plotly_dark', 'ggplot2', 'seaborn', 'simple_white'
-                legend=dict(  # Move the legend to the bottom
-                    orientation='h',
-                    yanchor='bottom',
-                    y=-0.6,
-                    xanchor='right',
-                    x=1,
-                    title=None,  # Remove legend title
-                ),
-                title={'y': 0.9, 'x': 0.5, 'xanchor': 'center', 'yanchor': 'top'},  # Center title
-            )
-            st.plotly_chart(fig_hr)
-
-
-            st.subheader('Vizualize locations of your activities')
-            # Get .fit.gz files referenced in activities.csv
-            listed_files = df['Filename']
-            listed_files = df['Filename'].loc[listed_files.str.contains('.fit.gz', na=False)]
-            # Extract files from activities.zip
-            with zipfile.ZipFile('uploads/activities.zip', 'r') as zip_ref:
-                zip_ref.extractall('uploads/')
-            # Get .fit.gz files available locally and referenced in activities.csv
-            available_files = glob.glob(os.path.join('uploads/activities/*.fit.gz'))
-            files = listed_files.tolist() and available_files
-            # Unzip those .fit.gz files
-            for f in files:
-                with gzip.open(f, 'rb') as f_in:
-                    with open('uploads/activities/' + Path(f).stem, 'wb') as f_out:
-                        shutil.copyfileobj(f_in, f_out)
-            # Remove .gz extension
-            files = [x[:-3] for x in files]
-            st.write(f'Number of FIT files in your data: {len(files)}')
-            # Read each FIT file and get the first pair of coordinates (if it exist)
-            # Initialize a DataFrame to hold coordinates
-            coords = pd.DataFrame(columns=['Filename (decompressed)', 'timestamp', 'lat', 'long'])
-            for f in files:
-                with fitdecode.FitReader(f) as fit_file:
-                    for frame in fit_file:
-                        if (isinstance(frame, fitdecode.records.FitDataMessage) and frame.name == 'record'):
-                            # See if there are coordinates
-                            try:
-                                new_row = pd.Series(
-                                    [f, frame.get_value('timestamp'), frame.get_value('position_lat') / 11930465, frame.get_value('position_long') / 11930465],
-                                    index=coords.columns,
-                                )
-                                coords = pd.concat([coords, new_row.to_frame().T], ignore_index=True)
-                                
-                                break
-                            except Exception:
-                                pass
-            # Enrich coords with activities.csv data into a new DataFrame, cdf
-            coords['Filename (decompressed)'] = coords['Filename (decompressed)'].str.replace('uploads/', '')
-            df['Filename (decompressed)'] = df['Filename'].str.replace('.gz', '')  # To match on filename
-            cdf = pd.merge(
-                left=df,
-                right=coords,
-                how='inner',
-                on=['Filename (decompressed)'],
-            )
-            
-            # Plot a scatter plot map
-            fig_map = px.scatter_geo(
-                cdf,
-                lat='lat',
-                lon='long',
-                size='Distance (km)',
-                color='Activity Type',
-                projection='natural earth',
-                title='Mapping my workouts!',  # Set title
-                opacity=0.75,  # Adjust opacity of dots
-                color_discrete_sequence=px.colors.qualitative.Bold,  # Define color swatch
-                custom_data=[  # Variables for the hover text
-                    'Activity Name',
-                    'Activity Date',
-                    'Distance (km)',
-                    'Average Speed (km/hr)',
-                    'Elevation Gain',
-                ],
-            )
-            # Center your map based on your coordinates
-            fig_map.update_geos(fitbounds='locations')
-            # Customize hover text
-            fig_map.update_traces(
-                hovertemplate='Activity Name: %{customdata[0]}<br>'
-                'Activity date: %{customdata[1]|%Y-%m-%d}<br>'
-                'Distance (km): %{customdata[2]:.1f}<br>'
-                'Average Speed (km/hr): %{customdata[3]:.1f}<br>'
-                'Elevation gain: %{customdata[4]:.1f}'
-            )
-            # Adjust the size and layout
-            fig_map.update_layout(
-                autosize=False,
-                width=750,
-                height=500,
-                legend=dict(  # Move the legend to the bottom
-                    orientation='h',
-                    yanchor='bottom',
-                    y=-0.1,
-                    xanchor='right',
-                    x=1,
-                    title=None,  # Remove legend title
-                ),
-                title={'y': 0.85, 'x': 0.5, 'xanchor': 'center', 'yanchor': 'top'},  # Center title
-            )
-            # Customize the colors of the map
-            fig_map.update_geos(
-                resolution=50,
-                showcountries=True, countrycolor='forestgreen',
-                showcoastlines=True, coastlinecolor='darkolivegreen',
-                showland=True, landcolor='darkseagreen',
-                showocean=True, oceancolor='lightcyan',
-                showlakes=True, lakecolor='LightBlue',
-                showrivers=True, rivercolor='LightBlue',
-            )
-            st.plotly_chart(fig_map)
-
-            shutil.rmtree('uploads')
-            
+            st.session_state['strava'] = {'df': df, 'rollups': rollups, 'coords': None, 'cdf': None, 'stats': None, 'zip_key': zip_key}
+            # Fit files are decoded in the background while the charts are shown
+            trace.track_memory = False
+            if keep:
+                st.session_state['fit_job'] = BackgroundJob(ingest_upload, export_store(df), uploaded_files)
+            else:
+                st.session_state['fit_job'] = BackgroundJob(decode_upload, zip_file, df)
         else:
-            st.warning('Upload CSV file of your summary activities and ZIP file with all activities before executing the code.')
\ No newline at end of file
+            st.warning('Upload CSV file of your summary activities and ZIP file with all activities before executing the code.')
+    if keep and st.button('Forget my stored activities'):
+        csv_files = [f for f in uploaded_files if f.name.endswith('.csv')]
+        if not csv_files:
+            st.warning('Upload the CSV file of your activities to delete what is stored for them.')
+        else:
+            df, _ = load_csv(upload_key(csv_files), csv_files[0], trace)
+            store = export_store(df)
+            job = st.session_state.get('fit_job')
+            if job is not None and not job.done():
+                # A running ingest saves to the store when it ends and would bring the activities back
+                with st.spinner('Waiting for the running upload to finish...'):
+                    job.wait()
+            if store.exists():
+                store.clear()
+                st.session_state.pop('strava', None)
+                st.session_state.pop('fit_job', None)
+                st.success('Stored activities deleted')
+            else:
+                st.info('Nothing is stored for these activities')
+
+    # Results are kept in the session so changing the time unit does not recompute them
+    if 'strava' in st.session_state:
+        from aggregation import TIME_UNITS
+        job = st.session_state.get('fit_job')
+        if job is not None and job.done():
+            finish_job(job, trace)
+            job = None
+        df = st.session_state['strava']['df']
+        rollups = st.session_state['strava']['rollups']
+        cdf = st.session_state['strava']['cdf']
+
+        st.subheader('This is the head of your data')
+        # Periods would reach the table as integer ordinals, show their labels instead
+        st.dataframe(df.assign(**{time_unit: df[time_unit].astype(str) for time_unit in TIME_UNITS}))
+        # Print date bounds of the data
+        st.write(f'Ranges from {df.Day.min()} to {df.Day.max()}')
+        # Define a time period by which you want to split your overall time
+        time_unit = st.selectbox('Time unit', TIME_UNITS, index=TIME_UNITS.index('Month'))
+        rollup = rollups[time_unit]
+
+
+        st.subheader('Vizualize your total cumulative distance covered')
+        with trace.stage('distance_figure') as stage:
+            # Includes the Plotly serialization done by st.plotly_chart
+            st.plotly_chart(distance_figure(rollup, time_unit))
+            stage['rows'] = len(rollup)
+
+
+        st.subheader('Vizualize your total time spent in each activity')
+        with trace.stage('time_figure') as stage:
+            st.plotly_chart(time_figure(rollup, time_unit))
+            stage['rows'] = len(rollup)
+
+
+        st.subheader('Vizualize locations of your activities')
+        # Filled in at the end of the script run once the fit files are decoded
+        map_slot = st.empty()
+        message_slot = st.empty()
+        if cdf is not None:
+            with trace.stage('map_figure') as stage:
+                map_slot.plotly_chart(map_figure(cdf))
+                stage['rows'] = len(cdf)
+        if 'fit_error' in st.session_state:
+            message_slot.error(st.session_state['fit_error'])
+        elif 'fit_message' in st.session_state:
+            message_slot.write(st.session_state['fit_message'])
+
+
+        # Filled in once the fit files are decoded, above the track analysis
+        places_slot = st.container()
+        if cdf is not None and not cdf.empty:
+            with places_slot:
+                places_section(cdf, trace)
+
+
+        tracks_section(df, uploaded_files, time_unit, trace)
+
+
+        activity_section(df, uploaded_files, trace)
+
+
+        if job is not None:
+            # Everything above is already on the page, wait for the fit files here
+            while not job.wait(PROGRESS_INTERVAL):
+                map_slot.progress(job.fraction)
+                message_slot.write(f'Decoding fit files: {job.done_count} of {job.total}')
+            finish_job(job, trace)
+            if 'fit_error' in st.session_state:
+                map_slot.empty()
+                message_slot.error(st.session_state['fit_error'])
+            else:
+                cdf = st.session_state['strava']['cdf']
+                with trace.stage('map_figure') as stage:
+                    map_slot.plotly_chart(map_figure(cdf))
+                    stage['rows'] = len(cdf)
+                message_slot.write(st.session_state['fit_message'])
+                if not cdf.empty:
+                    with places_slot:
+                        places_section(cdf, trace)
+
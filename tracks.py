@@ -0,0 +1,456 @@
+import gzip
+import io
+import time
+import zlib
+from functools import partial
+import fitdecode
+import numpy as np
+import pandas as pd
+from activity_files import FIT_CHUNKSIZE, FIT_WORKERS, SEMICIRCLES_PER_DEGREE, iter_xml_points, map_members, open_xml_member
+from buffers import RecordBuffer
+from efforts import EFFORT_DISTANCES, best_efforts
+from fit_cache import content_hash
+from geo import haversine_km
+
+# Seconds between the FIT epoch (1989-12-31) and the Unix epoch
+FIT_EPOCH = 631065600
+# Columns of a track with their array type codes, positions stay in semicircles
+TRACK_SCHEMA = {
+    'timestamp': 'd',
+    'lat': 'i',
+    'long': 'i',
+    'heart_rate': 'f',
+    'speed': 'f',
+    'altitude': 'f',
+    'distance': 'd',
+}
+# Stored for a missing position, the invalid value of FIT sint32 fields
+NO_POSITION = 0x7FFFFFFF
+# Global number of the FIT 'record' message
+RECORD_MESSAGE = 20
+# Fields of the record message read into a track: field number to column, scale and offset,
+# the enhanced speed and altitude fields come after the plain ones so they take precedence
+RECORD_FIELDS = {
+    253: ('timestamp', 1, 0),
+    0: ('lat', 1, 0),
+    1: ('long', 1, 0),
+    3: ('heart_rate', 1, 0),
+    5: ('distance', 100, 0),
+    6: ('speed', 1000, 0),
+    2: ('altitude', 5, 500),
+    73: ('speed', 1000, 0),
+    78: ('altitude', 5, 500),
+}
+# FIT base type number to NumPy type and invalid value
+BASE_TYPES = {
+    0: ('u1', 0xFF),
+    1: ('i1', 0x7F),
+    2: ('u1', 0xFF),
+    3: ('i2', 0x7FFF),
+    4: ('u2', 0xFFFF),
+    5: ('i4', 0x7FFFFFFF),
+    6: ('u4', 0xFFFFFFFF),
+    10: ('u1', 0),
+    11: ('u2', 0),
+    12: ('u4', 0),
+}
+# Time histograms have 1 bpm heart rate bins and 0.1 m/s speed bins
+HR_BINS = 256
+SPEED_STEP = 0.1
+SPEED_BINS = 300
+# Longer gaps between records are pauses and not counted as time in any bin
+MAX_GAP_SECONDS = 30
+# Per activity summaries computed from the tracks with their number of values
+SUMMARIES = {'hr_seconds': HR_BINS, 'speed_seconds': SPEED_BINS, 'best_efforts': len(EFFORT_DISTANCES)}
+
+
+class UnsupportedFit(ValueError):
+    """
+    Raised by scan_records for FIT files the fast reader does not handle, such as compressed timestamp headers.
+    """
+
+
+def scan_records(data):
+    """
+    Walk the messages of a FIT file and collect the positions of 'record' messages by definition.
+
+    Only the message headers are looked at, so each message costs a few byte lookups and no
+    objects are built for it. Chained FIT files are followed to the end.
+
+    Parameters:
+    data (bytes): Decompressed FIT data.
+
+    Returns:
+    dict: Mapping of (architecture, field definitions) of each record message definition to the
+    list of byte offsets of its messages.
+    """
+    groups = {}
+    pos = 0
+    while pos + 12 <= len(data):
+        if data[pos + 8:pos + 12] != b'.FIT':
+            raise UnsupportedFit('Not a FIT file')
+        # A truncated file ends in the middle of a message, read_track drops incomplete records
+        end = min(pos + data[pos] + int.from_bytes(data[pos + 4:pos + 8], 'little'), len(data))
+        pos += data[pos]
+        # Size and record offsets list (None for other messages) of each local message type
+        local = {}
+        while pos < end:
+            header = data[pos]
+            if header & 0x80:
+                raise UnsupportedFit('Compressed timestamp headers')
+            if header & 0x40:
+                if pos + 6 > end:
+                    break
+                architecture = data[pos + 2]
+                global_number = int.from_bytes(data[pos + 3:pos + 5], 'big' if architecture else 'little')
+                fields = data[pos + 6:pos + 6 + 3 * data[pos + 5]]
+                pos += 6 + len(fields)
+                size = sum(fields[1::3])
+                if header & 0x20 and pos < end:
+                    # Developer fields only add to the message size
+                    developer = data[pos + 1:pos + 1 + 3 * data[pos]]
+                    size += sum(developer[1::3])
+                    pos += 1 + len(developer)
+                offsets = groups.setdefault((architecture, fields), []) if global_number == RECORD_MESSAGE else None
+                local[header & 0x0F] = (size, offsets)
+            else:
+                size, offsets = local[header & 0x0F]
+                if offsets is not None:
+                    offsets.append(pos + 1)
+                pos += 1 + size
+        # Skip the file CRC
+        pos = end + 2
+    return groups
+
+
+def read_track(data):
+    """
+    Read every 'record' message of a FIT file into typed column arrays.
+
+    The message offsets come from scan_records, each field is then gathered for all messages of a
+    definition at once with NumPy. Missing heart rate, speed, altitude and distance are NaN and
+    missing positions NO_POSITION. Files scan_records does not handle are read with fitdecode.
+
+    Parameters:
+    data (bytes): Decompressed FIT data.
+
+    Returns:
+    dict: Mapping of each TRACK_SCHEMA column to a NumPy array sorted by time, timestamps as POSIX seconds.
+    """
+    try:
+        groups = scan_records(data)
+    except UnsupportedFit:
+        return read_track_fitdecode(io.BytesIO(data))
+    buffer = np.frombuffer(data, dtype=np.uint8)
+    parts = []
+    for (architecture, fields), offsets in groups.items():
+        if not offsets:
+            continue
+        offsets = np.array(offsets, dtype=np.int64)
+        starts = {}
+        position = 0
+        for i in range(0, len(fields), 3):
+            starts[fields[i]] = (position, fields[i + 1], fields[i + 2] & 0x1F)
+            position += fields[i + 1]
+        # The last message of a truncated file is incomplete
+        offsets = offsets[offsets + position <= len(buffer)]
+        columns = {column: np.full(len(offsets), np.nan) for column in TRACK_SCHEMA}
+        columns['offset'] = offsets
+        for number, (column, scale, offset) in RECORD_FIELDS.items():
+            if number not in starts or starts[number][2] not in BASE_TYPES:
+                continue
+            start, size, base_type = starts[number]
+            code, invalid = BASE_TYPES[base_type]
+            dtype = np.dtype(code).newbyteorder('>' if architecture else '<')
+            if size != dtype.itemsize:
+                continue
+            raw = buffer[offsets[:, None] + start + np.arange(size)].view(dtype).ravel()
+            valid = raw != invalid
+            columns[column][valid] = raw[valid] / scale - offset
+        parts.append(columns)
+    if not parts:
+        return {column: np.array([], dtype=code) for column, code in TRACK_SCHEMA.items()}
+    merged = {column: np.concatenate([part[column] for part in parts]) for column in [*TRACK_SCHEMA, 'offset']}
+    # Definitions can change in the middle of a file, the byte offset keeps the records in order
+    order = np.argsort(merged['offset'], kind='stable')
+    order = order[~np.isnan(merged['timestamp'][order])]
+    track = {}
+    for column, code in TRACK_SCHEMA.items():
+        values = merged[column][order]
+        if column in ('lat', 'long'):
+            values = np.where(np.isnan(values), NO_POSITION, values)
+        elif column == 'timestamp':
+            values = values + FIT_EPOCH
+        track[column] = values.astype(code)
+    return track
+
+
+def read_track_fitdecode(stream):
+    """
+    Read every 'record' message of a FIT file into typed column arrays with fitdecode.
+
+    Slower than read_track, used for the files it does not handle.
+
+    Parameters:
+    stream (file-like): Decompressed FIT data.
+
+    Returns:
+    dict: Mapping of each TRACK_SCHEMA column to a NumPy array, timestamps as POSIX seconds.
+    """
+    track = RecordBuffer(TRACK_SCHEMA)
+    nan = float('nan')
+    with fitdecode.FitReader(stream, processor=fitdecode.DataProcessorBase(),
+                             check_crc=fitdecode.CrcCheck.DISABLED) as fit_file:
+        for frame in fit_file:
+            if not (isinstance(frame, fitdecode.records.FitDataMessage) and frame.name == 'record'):
+                continue
+            values = {field.name: field.value for field in frame.fields}
+            timestamp = values.get('timestamp')
+            if timestamp is None:
+                continue
+            lat, long = values.get('position_lat'), values.get('position_long')
+            speed = values.get('enhanced_speed', values.get('speed'))
+            altitude = values.get('enhanced_altitude', values.get('altitude'))
+            heart_rate, distance = values.get('heart_rate'), values.get('distance')
+            track.append(
+                timestamp + FIT_EPOCH,
+                NO_POSITION if lat is None or long is None else lat,
+                NO_POSITION if lat is None or long is None else long,
+                nan if heart_rate is None else heart_rate,
+                nan if speed is None else speed,
+                nan if altitude is None else altitude,
+                nan if distance is None else distance,
+            )
+    return track.to_arrays()
+
+
+def read_xml_track(stream):
+    """
+    Read every point of a GPX or TCX file into the typed column arrays of read_track.
+
+    GPX files carry no distance and rarely a speed, those are then derived from the positions.
+
+    Parameters:
+    stream (file-like): Decompressed GPX or TCX data.
+
+    Returns:
+    dict: Mapping of each TRACK_SCHEMA column to a NumPy array sorted by time, timestamps as POSIX seconds.
+    """
+    columns = [column for column in TRACK_SCHEMA if column != 'timestamp']
+    points = RecordBuffer({'timestamp': None, **{column: 'd' for column in columns}})
+    nan = float('nan')
+    for point in iter_xml_points(stream):
+        if 'timestamp' in point:
+            points.append(point['timestamp'], *(float(point[column]) if column in point else nan for column in columns))
+    values = points.to_arrays()
+    # Times without a zone are UTC, as the GPX and TCX schemas require
+    times = pd.to_datetime(values.pop('timestamp'), utc=True, format='ISO8601')
+    timestamp = ((times - pd.Timestamp(0, tz='UTC')) / pd.Timedelta(seconds=1)).to_numpy(dtype=float)
+    order = np.argsort(timestamp, kind='stable')
+    values = {column: array[order] for column, array in values.items()}
+    timestamp = timestamp[order]
+    positioned = np.flatnonzero(~np.isnan(values['lat']) & ~np.isnan(values['long']))
+    if np.isnan(values['distance']).all() and len(positioned):
+        lat, long = values['lat'][positioned], values['long'][positioned]
+        steps = haversine_km(lat[1:], long[1:], lat[:-1], long[:-1]) * 1000
+        values['distance'][positioned] = np.concatenate([[0.0], np.cumsum(steps)])
+    if np.isnan(values['speed']).all():
+        measured = np.flatnonzero(~np.isnan(values['distance']))
+        seconds = np.diff(timestamp[measured])
+        values['speed'][measured[1:]] = np.divide(np.diff(values['distance'][measured]), seconds,
+                                                  out=np.full(len(seconds), np.nan), where=seconds > 0)
+    track = {'timestamp': timestamp.astype(TRACK_SCHEMA['timestamp'])}
+    for column in columns:
+        array = values[column]
+        if column in ('lat', 'long'):
+            array = np.where(np.isnan(array), NO_POSITION, np.round(array * SEMICIRCLES_PER_DEGREE))
+        track[column] = array.astype(TRACK_SCHEMA[column])
+    return track
+
+
+def read_member_track(filename, data):
+    """
+    Read the track of an activity file whatever its format.
+
+    Parameters:
+    filename (str): Listed filename, its suffix tells the format.
+    data (bytes): Raw member bytes.
+
+    Returns:
+    dict: Output of read_track or read_xml_track.
+    """
+    if filename.endswith('.fit.gz'):
+        return read_track(gzip.decompress(data))
+    return read_xml_track(open_xml_member(filename, data))
+
+
+def time_histograms(track):
+    """
+    Count the seconds spent at each heart rate and speed of a track.
+
+    Each record gets the time until the next one, so a histogram sums to the moving time.
+
+    Parameters:
+    track (dict): Output of read_track.
+
+    Returns:
+    tuple: float32 arrays of seconds per heart rate bin (HR_BINS) and per speed bin (SPEED_BINS).
+    """
+    dt = np.diff(track['timestamp'], append=track['timestamp'][-1:])
+    dt[(dt < 0) | (dt > MAX_GAP_SECONDS)] = 0
+    histograms = []
+    for column, step, bins in [('heart_rate', 1, HR_BINS), ('speed', SPEED_STEP, SPEED_BINS)]:
+        values = track[column]
+        valid = ~np.isnan(values)
+        index = np.clip((values[valid] / step).astype(np.int64), 0, bins - 1)
+        histograms.append(np.bincount(index, weights=dt[valid], minlength=bins).astype(np.float32))
+    return tuple(histograms)
+
+
+def pack_track(track):
+    """
+    Serialize a track into compressed bytes for the track cache.
+
+    Parameters:
+    track (dict): Output of read_track.
+
+    Returns:
+    bytes: zlib compressed column arrays one after the other in TRACK_SCHEMA order.
+    """
+    return zlib.compress(b''.join(track[column].tobytes() for column in TRACK_SCHEMA), 1)
+
+
+def unpack_track(data):
+    """
+    Read a track serialized by pack_track.
+
+    Parameters:
+    data (bytes): Packed track.
+
+    Returns:
+    dict: Mapping of each TRACK_SCHEMA column to a NumPy array.
+    """
+    data = zlib.decompress(data)
+    dtypes = [np.dtype(code) for code in TRACK_SCHEMA.values()]
+    n = len(data) // sum(dtype.itemsize for dtype in dtypes)
+    track, offset = {}, 0
+    for column, dtype in zip(TRACK_SCHEMA, dtypes):
+        track[column] = np.frombuffer(data, dtype=dtype, count=n, offset=offset)
+        offset += n * dtype.itemsize
+    return track
+
+
+def summarize_track(track):
+    """
+    Reduce a track to the per activity summaries of SUMMARIES.
+
+    Parameters:
+    track (dict): Output of read_track.
+
+    Returns:
+    dict: Mapping of summary name to a float32 array.
+    """
+    hr_seconds, speed_seconds = time_histograms(track)
+    return {
+        'hr_seconds': hr_seconds,
+        'speed_seconds': speed_seconds,
+        'best_efforts': best_efforts(track['distance'], track['timestamp'], list(EFFORT_DISTANCES.values())),
+    }
+
+
+def decode_track_chunk(chunk, keep_tracks=False):
+    """
+    Read the full track of every activity file in a chunk and reduce it to summaries, used as the process pool worker.
+
+    Parameters:
+    chunk (list): Pairs of listed filename and raw member bytes.
+    keep_tracks (bool): Also return the packed tracks, for the track cache.
+
+    Returns:
+    list: Tuples of filename, each summary of SUMMARIES as bytes and the packed track or None,
+    all values are None for files that could not be read.
+    """
+    results = []
+    for filename, data in chunk:
+        try:
+            track = read_member_track(filename, data)
+        except Exception:
+            # Skip corrupted or truncated files instead of failing the whole export
+            track = None
+        if track is None or len(track['timestamp']) == 0:
+            results.append((filename, *(None for _ in SUMMARIES), None))
+            continue
+        summaries = summarize_track(track)
+        results.append((filename, *(summaries[name].tobytes() for name in SUMMARIES), pack_track(track) if keep_tracks else None))
+    return results
+
+
+def decode_track_summaries(zip_path, filenames, max_workers=FIT_WORKERS, chunksize=FIT_CHUNKSIZE, cache=None):
+    """
+    Read the full tracks of the listed FIT, GPX and TCX files in parallel and keep only their summaries.
+
+    Tracks never reach the calling process, each worker reduces its files to the small arrays of
+    SUMMARIES, so memory stays bounded by the number of files rather than records. With a cache
+    the packed tracks are stored for later and files seen before are not read again.
+
+    Parameters:
+    zip_path (str or file-like): Path to the ZIP archive or the uploaded file itself.
+    filenames (iterable): 'Filename' values from activities.csv.
+    max_workers (int): Number of worker processes, 1 decodes in the calling process.
+    chunksize (int): Number of files sent to a worker at once.
+    cache (TrackCache): Optional persistent cache of tracks and summaries.
+
+    Returns:
+    tuple: Listed filenames, a dict of float32 matrices per summary with one row per filename,
+    and a dict with throughput stats.
+    """
+    start_time = time.perf_counter()
+    names = []
+    rows = {name: [] for name in SUMMARIES}
+    hashes = {}
+    counts = {}
+    n_decoded = 0
+
+    def collect(filename, *summaries):
+        if summaries[0] is not None:
+            names.append(filename)
+            for name, summary in zip(SUMMARIES, summaries):
+                rows[name].append(np.frombuffer(summary, dtype=np.float32))
+
+    def uncached(chunk):
+        # Serve the files seen before from the cache and return the rest
+        chunk_hashes = {filename: content_hash(data) for filename, data in chunk}
+        found = cache.get_summaries(list(chunk_hashes.values()))
+        missing = []
+        for filename, data in chunk:
+            h = chunk_hashes[filename]
+            if h in found:
+                collect(filename, *found[h])
+            else:
+                hashes[filename] = h
+                missing.append((filename, data))
+        return missing
+
+    worker = partial(decode_track_chunk, keep_tracks=cache is not None)
+    for decoded in map_members(zip_path, filenames, worker, max_workers, chunksize,
+                               uncached=uncached if cache is not None else None, counts=counts):
+        n_decoded += len(decoded)
+        for filename, *summaries, _ in decoded:
+            collect(filename, *summaries)
+        if cache is not None:
+            cache.put_many([(hashes.pop(filename), *values) for filename, *values in decoded])
+
+    matrices = {
+        name: np.vstack(rows[name]) if rows[name] else np.zeros((0, size), dtype=np.float32)
+        for name, size in SUMMARIES.items()
+    }
+    seconds = time.perf_counter() - start_time
+    stats = {
+        'files': counts['files'],
+        'decoded': n_decoded,
+        'seconds': seconds,
+        'files_per_second': counts['files'] / seconds if seconds > 0 else 0.0,
+    }
+    if cache is not None:
+        stats.update({f'cache_{k}': v for k, v in cache.stats().items()})
+    return names, matrices, stats
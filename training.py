@@ -58,8 +58,34 @@ def app():
         ]
     }
 
+    # Recommend a session from the training load of the activities uploaded on the strava page
+    results = st.session_state.get('strava')
+    recommended = None
+    if results is not None and len(results['df']):
+        import pandas as pd
+        from training_load import build_training_load, recommend_session
+        df = results['df']
+        if results.get('load') is None:
+            # Kept with the activities in the session, activities of an athlete store come with it
+            results['load'] = build_training_load(df)
+        load = results['load']
+        today = pd.Timestamp.today().to_period('D')
+        # Old exports would only show a fully rested athlete today, start the day after the last activity
+        day = st.date_input('Session date', value=min(today, df['Day'].max() + 1).to_timestamp())
+        recommended = recommend_session(df, load, pd.Period(day, freq='D'))
+        st.markdown(f"Fitness (CTL) {recommended['CTL']:.0f}, fatigue (ATL) {recommended['ATL']:.0f}, "
+                    f"form (TSB) {recommended['TSB']:+.0f}")
+        st.markdown(f"Your training load suggests: **{recommended['type']}** for about **{recommended['minutes']} minutes**.")
+        with st.expander('Training load over the last year'):
+            recent = load[['ATL', 'CTL', 'TSB']].iloc[-365:]
+            st.line_chart(recent.set_axis(recent.index.to_timestamp()))
+    else:
+        st.info('Upload your activities on the strava page to get a session fitted to your training load.')
+
     # Training type selection
-    selected_type = st.selectbox('Select Training Type', list(training_dict.keys()))
+    training_types = list(training_dict.keys())
+    selected_type = st.selectbox('Select Training Type', training_types,
+                                 index=training_types.index(recommended['type']) if recommended else 0)
 
     # Display a random training example for the selected type
     st.markdown(f'Today for your {selected_type} you get:')
@@ -0,0 +1,183 @@
+import numpy as np
+import pandas as pd
+
+# Time constants in days of the acute (fatigue) and chronic (fitness) training load
+ATL_DAYS = 7
+CTL_DAYS = 42
+# Load of one minute of an activity without a Relative Effort, about the effort of easy running
+LOAD_PER_MINUTE = 1.0
+# Columns of the training load series, indexed by day
+LOAD_COLUMNS = ['Load', 'ATL', 'CTL', 'TSB']
+# Session types of the training generator from the most to the least demanding, with the lowest
+# training stress balance (form, CTL - ATL) each one is recommended at
+SESSION_FORM = {'Long Run': 5, 'Speed Workout': -10, 'Easy Run': -25, 'Cross-Training': float('-inf')}
+# Intensity of the session types relative to the usual load per minute of the athlete
+SESSION_INTENSITY = {'Long Run': 0.9, 'Speed Workout': 1.4, 'Easy Run': 0.7, 'Cross-Training': 0.6}
+# Load of the session types as a multiple of the chronic load, the ones at or above it also get the
+# extra load that raises the CTL by RAMP_PER_WEEK points a week
+RAMP_PER_WEEK = 5
+SESSION_LOAD = {'Long Run': 1.5, 'Speed Workout': 1.0, 'Easy Run': 0.5, 'Cross-Training': 0.3}
+# Bounds in minutes of a recommended session
+MIN_SESSION_MINUTES = 20
+MAX_SESSION_MINUTES = 180
+
+
+def activity_load(df):
+    """
+    Get the training load of every activity.
+
+    The load is the Relative Effort of the activity, activities recorded without a heart rate
+    count LOAD_PER_MINUTE for every minute of moving time instead.
+
+    Parameters:
+    df (pandas.DataFrame): Activities.
+
+    Returns:
+    pandas.Series: Load of each activity.
+    """
+    minutes = df['Moving Time'].fillna(0) / 60
+    return df['Relative Effort'].astype('float64').fillna(minutes * LOAD_PER_MINUTE)
+
+
+def daily_load(df):
+    """
+    Sum the load of activities by day.
+
+    Parameters:
+    df (pandas.DataFrame): Activities with period columns.
+
+    Returns:
+    pandas.Series: Load per 'Day' period, only days with activities.
+    """
+    return activity_load(df).groupby(df['Day']).sum()
+
+
+def load_series(daily, previous=None):
+    """
+    Compute the acute and chronic load over a range of days with exponentially weighted means.
+
+    Each day moves ATL and CTL towards its load by 1/ATL_DAYS and 1/CTL_DAYS of the difference.
+    With the ATL and CTL of the day before the range the series continues an earlier one exactly,
+    the recursion of ewm(adjust=False) starts from the first value, the previous one is prepended.
+
+    Parameters:
+    daily (pandas.Series): Load per 'Day' period, only days with activities.
+    previous (pandas.Series): Row of the series to continue, named by its day, the series starts from zero when None.
+
+    Returns:
+    pandas.DataFrame: LOAD_COLUMNS for every day from the first day of daily, or the day after
+    previous, to the last day of daily.
+    """
+    first = daily.index.min() if previous is None else previous.name + 1
+    days = pd.period_range(first, daily.index.max(), freq='D')
+    load = daily.reindex(days, fill_value=0.0).astype('float64')
+    frame = pd.DataFrame({'Load': load}, index=days)
+    for column, span in [('ATL', ATL_DAYS), ('CTL', CTL_DAYS)]:
+        start = 0.0 if previous is None else previous[column]
+        seeded = np.concatenate([[start], load.to_numpy()])
+        frame[column] = pd.Series(seeded).ewm(alpha=1 / span, adjust=False).mean().to_numpy()[1:]
+    frame['TSB'] = frame['CTL'] - frame['ATL']
+    frame.index.name = 'Day'
+    return frame
+
+
+def build_training_load(df):
+    """
+    Compute the training load series of all activities.
+
+    Parameters:
+    df (pandas.DataFrame): Activities with period columns.
+
+    Returns:
+    pandas.DataFrame: Output of load_series, empty without activities.
+    """
+    daily = daily_load(df)
+    if daily.empty:
+        return pd.DataFrame(columns=LOAD_COLUMNS, index=pd.PeriodIndex([], freq='D', name='Day'), dtype='float64')
+    return load_series(daily)
+
+
+def update_training_load(load, added=None, removed=None):
+    """
+    Update the training load series with added and removed activities without going over the whole history.
+
+    Days before the first changed day keep their values, the series is continued from the day
+    before it with the stored loads and the changes.
+
+    Parameters:
+    load (pandas.DataFrame): Output of build_training_load or update_training_load.
+    added (pandas.DataFrame): New activities.
+    removed (pandas.DataFrame): Activities to take out, e.g. the previous version of changed ones.
+
+    Returns:
+    pandas.DataFrame: Updated series.
+    """
+    parts = []
+    if added is not None and len(added):
+        parts.append(daily_load(added))
+    if removed is not None and len(removed):
+        parts.append(-daily_load(removed))
+    if not parts:
+        return load
+    changes = pd.concat(parts).groupby(level=0).sum()
+    start = changes.index.min()
+    kept = load.loc[load.index < start]
+    # Stored loads of the days from the first change on, with the changes added
+    daily = load.loc[load.index >= start, 'Load'].add(changes, fill_value=0.0)
+    previous = kept.iloc[-1] if len(kept) else None
+    return pd.concat([kept, load_series(daily, previous)])
+
+
+def load_on(load, day):
+    """
+    Get ATL, CTL and TSB on a day, continued without activities after the end of the series.
+
+    Without load both averages decay geometrically, so days after the series are computed in closed form.
+
+    Parameters:
+    load (pandas.DataFrame): Output of build_training_load or update_training_load.
+    day (pandas.Period): Day of interest.
+
+    Returns:
+    dict: 'ATL', 'CTL' and 'TSB' on the day, zeros before the first activity.
+    """
+    known = load.loc[load.index <= day]
+    if known.empty:
+        return {'ATL': 0.0, 'CTL': 0.0, 'TSB': 0.0}
+    last = known.iloc[-1]
+    rest = day.ordinal - known.index[-1].ordinal
+    atl = float(last['ATL']) * (1 - 1 / ATL_DAYS) ** rest
+    ctl = float(last['CTL']) * (1 - 1 / CTL_DAYS) ** rest
+    return {'ATL': atl, 'CTL': ctl, 'TSB': ctl - atl}
+
+
+def recommend_session(df, load, day):
+    """
+    Recommend the type and duration of the next session from the current form.
+
+    The type is the most demanding one of SESSION_FORM the form allows. Its target load is a
+    multiple of the chronic load (SESSION_LOAD, plus the weekly ramp for the demanding ones), turned
+    into minutes with the usual load per minute of the athlete's recent activities.
+
+    Parameters:
+    df (pandas.DataFrame): Activities with period columns.
+    load (pandas.DataFrame): Output of build_training_load or update_training_load.
+    day (pandas.Period): Day of the session.
+
+    Returns:
+    dict: 'type', 'minutes' and the 'ATL', 'CTL' and 'TSB' the recommendation is based on.
+    """
+    state = load_on(load, day)
+    session = next(name for name, form in SESSION_FORM.items() if state['TSB'] >= form)
+    # Usual load per minute over the last CTL_DAYS days of activities, the whole history if there are none
+    recent = df.loc[(df['Day'] <= day) & (df['Day'] > day - CTL_DAYS)]
+    recent = recent if len(recent) else df
+    minutes = recent['Moving Time'].sum() / 60
+    per_minute = activity_load(recent).sum() / minutes if minutes > 0 else LOAD_PER_MINUTE
+    target = state['CTL'] * SESSION_LOAD[session]
+    if SESSION_LOAD[session] >= 1:
+        # Daily load above the CTL by this much raises it by RAMP_PER_WEEK over a week
+        target += RAMP_PER_WEEK * CTL_DAYS / 7
+    duration = target / (per_minute * SESSION_INTENSITY[session]) if per_minute > 0 else MIN_SESSION_MINUTES
+    duration = 5 * round(min(max(duration, MIN_SESSION_MINUTES), MAX_SESSION_MINUTES) / 5)
+    return {'type': session, 'minutes': int(duration), **state}
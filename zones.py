@@ -0,0 +1,96 @@
+import numpy as np
+import pandas as pd
+from tracks import HR_BINS, SPEED_BINS, SPEED_STEP
+
+# Heart rate zones as fractions of the maximum heart rate, zone 1 is everything below the first bound
+HR_ZONES = {'Z1 Recovery': 0.0, 'Z2 Endurance': 0.6, 'Z3 Tempo': 0.7, 'Z4 Threshold': 0.8, 'Z5 VO2max': 0.9}
+# Pace zones as fractions of the threshold pace, slower paces come first
+PACE_ZONES = {'Z1 Recovery': float('inf'), 'Z2 Endurance': 1.29, 'Z3 Tempo': 1.14, 'Z4 Threshold': 1.06, 'Z5 VO2max': 0.99}
+# Slower speeds in m/s are standing still and not counted in any pace zone
+MIN_MOVING_SPEED = 0.5
+
+
+def zone_matrix(bin_values, bounds):
+    """
+    Map fine histogram bins to zones.
+
+    Parameters:
+    bin_values (numpy.ndarray): Lower value of each bin.
+    bounds (list): Increasing lower bounds of the zones.
+
+    Returns:
+    numpy.ndarray: One-hot matrix with one row per bin and one column per zone.
+    """
+    zones = np.searchsorted(bounds, bin_values, side='right') - 1
+    matrix = np.zeros((len(bin_values), len(bounds)), dtype=np.float32)
+    inside = zones >= 0
+    matrix[np.flatnonzero(inside), zones[inside]] = 1
+    return matrix
+
+
+def hr_zone_seconds(hr_seconds, max_hr):
+    """
+    Sum the seconds per heart rate bin into heart rate zones for many activities at once.
+
+    Parameters:
+    hr_seconds (numpy.ndarray): Seconds per 1 bpm bin, one row per activity.
+    max_hr (float): Maximum heart rate of the athlete.
+
+    Returns:
+    pandas.DataFrame: Seconds per zone (HR_ZONES), one row per activity.
+    """
+    bounds = np.array(list(HR_ZONES.values())) * max_hr
+    return pd.DataFrame(hr_seconds @ zone_matrix(np.arange(HR_BINS), bounds), columns=list(HR_ZONES))
+
+
+def pace_zone_seconds(speed_seconds, threshold_pace):
+    """
+    Sum the seconds per speed bin into pace zones for many activities at once.
+
+    Parameters:
+    speed_seconds (numpy.ndarray): Seconds per SPEED_STEP bin, one row per activity.
+    threshold_pace (float): Threshold pace in minutes per kilometer, positive.
+
+    Returns:
+    pandas.DataFrame: Seconds per zone (PACE_ZONES), one row per activity.
+    """
+    if threshold_pace <= 0:
+        raise ValueError(f'Threshold pace must be positive: {threshold_pace!r}')
+    threshold_speed = 1000 / (threshold_pace * 60)
+    # A pace fraction turns into a speed bound, slower zones have lower speeds
+    bounds = threshold_speed / np.array(list(PACE_ZONES.values()))
+    bounds[0] = MIN_MOVING_SPEED
+    return pd.DataFrame(speed_seconds @ zone_matrix(np.arange(SPEED_BINS) * SPEED_STEP, bounds), columns=list(PACE_ZONES))
+
+
+def zones_per_activity(df, filenames, zone_seconds):
+    """
+    Join the zone times of activities with their activities.csv data.
+
+    Parameters:
+    df (pandas.DataFrame): Activities with period columns.
+    filenames (list): 'Filename' of each row of zone_seconds.
+    zone_seconds (pandas.DataFrame): Output of hr_zone_seconds or pace_zone_seconds.
+
+    Returns:
+    pandas.DataFrame: Name, date, type and periods of each activity with its minutes per zone.
+    """
+    minutes = zone_seconds.div(60).astype('float32').assign(Filename=filenames)
+    columns = ['Filename', 'Activity Name', 'Activity Date', 'Activity Type', 'Day', 'Week', 'Month', 'Quarter', 'Year']
+    return pd.merge(df[columns], minutes, how='inner', on='Filename')
+
+
+def zones_per_period(activity_zones, zones, time_unit):
+    """
+    Sum the zone times of activities by time period.
+
+    Parameters:
+    activity_zones (pandas.DataFrame): Output of zones_per_activity.
+    zones (list): Zone columns, HR_ZONES or PACE_ZONES.
+    time_unit (str): One of TIME_UNITS.
+
+    Returns:
+    pandas.DataFrame: Long format with the period, the zone and its hours.
+    """
+    totals = activity_zones.groupby(time_unit, observed=True)[list(zones)].sum() / 60
+    return totals.reset_index().melt(id_vars=time_unit, var_name='Zone', value_name='Hours')